@@ -0,0 +1,38 @@
+# sequences per second of CRF.predict on random sequences
+#   python bench/crf_predict.py [--sequences N] [--labels L] [--features F]
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from crf import CRF
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sequences', type=int, default=2000)
+    parser.add_argument('--labels',    type=int, default=10)
+    parser.add_argument('--features',  type=int, default=50)
+    parser.add_argument('--maxLength', type=int, default=30)
+    parser.add_argument('--repeats',   type=int, default=3)
+    args = parser.parse_args()
+
+    rng   = np.random.default_rng(0)
+    L, F  = args.labels, args.features
+    insts = [ (rng.random(size=(int(rng.integers(2, args.maxLength + 1)), F))
+               < 0.1).astype(float) for i in range(args.sequences) ]
+    crf   = CRF(rng.normal(size=(L, F)), rng.normal(size=(L, L)), None, None)
+
+    best = np.inf
+    for r in range(args.repeats):
+        start = time.time()
+        crf.predict(insts)
+        best  = min(best, time.time() - start)
+    print("predict: %d sequences (%d labels, %d features) in %.3fs, "
+          "%.0f sequences/s" % (args.sequences, L, F, best,
+                                args.sequences / best))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# speedup curve of BayesNet.learnParallel over a memory-mapped matrix
+#   python bench/learn_parallel.py [--rows N] [--workers 1,2,4,8]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from BayesNet import BayesNet
+
+# a chain a0 -> a1 -> ... of nVars variables with the given domain
+def chainNet(nVars, domain):
+    variables = [ 'a' + str(i) for i in range(nVars) ]
+    conditionals = [ [ variables[0] ] ] + [ [ variables[i], variables[i-1] ]
+                                            for i in range(1, nVars) ]
+    return BayesNet(variables, [ domain ] * nVars, conditionals)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows',      type=int, default=2000000)
+    parser.add_argument('--vars',      type=int, default=20)
+    parser.add_argument('--domain',    type=int, default=4)
+    parser.add_argument('--chunkRows', type=int, default=100000)
+    parser.add_argument('--workers',   default='1,2,4,8')
+    args = parser.parse_args()
+
+    tmp  = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'data.npy')
+    try:
+        rng = np.random.default_rng(0)
+        np.save(path, rng.integers(0, args.domain,
+                                   size=(args.rows, args.vars)))
+
+        start = time.time()
+        chainNet(args.vars, args.domain).learn(np.load(path))
+        print("learn (serial, in memory): %.3fs" % (time.time() - start))
+
+        base = None
+        for nWorkers in [ int(w) for w in args.workers.split(',') ]:
+            start = time.time()
+            chainNet(args.vars, args.domain).learnParallel(
+                path, nWorkers, args.chunkRows)
+            elapsed = time.time() - start
+            base    = base or elapsed
+            print("learnParallel, %2d workers: %.3fs (speedup %.2fx)" %
+                  (nWorkers, elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
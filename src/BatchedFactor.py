@@ -0,0 +1,67 @@
+import numpy as np
+from   scipy.special import logsumexp
+from   Factor        import Factor
+
+class BatchedFactor(Factor):
+    """
+    A stack of log factors that all have the same scope.  The tensor has a
+    leading batch axis in front of the variable axes and every operation
+    (add, observe, eliminate, marginal, logZ, toProbs) is applied to the
+    whole batch with one numpy call
+    """
+    __slots__ = ()
+
+    _NBATCH = 1
+
+    # factor is a numpy array of shape (batchSize,) + domains; as with
+    # Factor, it MUST be in log space
+    def __init__(self, variables, domains, factor):
+        assert np.ndim(factor) == len(variables) + 1, (
+            "Batched factor must have a leading batch axis!")
+        Factor.__init__(self, variables, domains, factor)
+
+    # stack a list of factors over the same variables into one batch
+    @staticmethod
+    def stack(factors):
+        assert len(factors) > 0, "Must pass in at least one factor"
+        variables = factors[0]._vars
+        tensors   = []
+        for f in factors:
+            assert set(f._vars) == set(variables), (
+                "All factors in a batch must have the same variables!")
+            perm = [ f._vars.index(v) for v in variables ]
+            tensors.append(np.transpose(f._factor, perm))
+        return BatchedFactor(variables, factors[0]._domains, np.array(tensors))
+
+    def batchSize(self):
+        return self._factor.shape[0]
+
+    # return the i-th factor of the batch as a plain Factor (shares the
+    # tensor; both copy before their next write)
+    def unstack(self, i):
+        self._shared = True
+        return Factor._new(self._vars, self._domains, self._factor[i],
+                           self._assigned, True)
+
+    # assignment maps each variable to either a single value or an array
+    # holding one value per batch entry; returns one entry per batch entry
+    def get(self, assignment):
+        assert set(assignment.keys()) == set(self._vars), (
+            "Assignment/Joint variables must match!")
+        for var, val in assignment.items():
+            assert np.all(self._domain(var) > np.asarray(val)), (
+                "Value outside the valid domain of var: " + str(var))
+
+        index = [ np.arange(self.batchSize()) ] + [ assignment[v]
+                                                    for v in self._vars ]
+        return self._factor[tuple(index)]
+
+    # visual representation
+    def show(self):
+        return str(self.batchSize()) + " x " + Factor.show(self)
+
+    # log of the partition function of every factor in the batch
+    def logZ(self):
+        if len(self._vars) == 0:
+            return self._factor
+        return logsumexp(self._factor, axis=tuple(range(1, self._factor.ndim)))
@@ -1,5 +1,41 @@
 import numpy as np
-from   CPT import CPT
+from   itertools       import islice
+from   multiprocessing import Pool
+from   CPT             import CPT
+from   Factor          import Factor
+from   JunctionTree    import eliminationOrder
+
+# yields chunkSize rows at a time of an integer matrix saved with np.save;
+# the file is memory-mapped so only one chunk is ever read into memory
+def npyChunks(path, chunkSize):
+    data = np.load(path, mmap_mode='r')
+    for start in range(0, data.shape[0], chunkSize):
+        yield np.array(data[start:start + chunkSize])
+
+# yields chunkSize rows at a time of a delimited text file of integers
+def csvChunks(path, chunkSize, delimiter=','):
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunkSize))
+            if len(lines) == 0:
+                return
+            yield np.loadtxt(lines, dtype=int, delimiter=delimiter, ndmin=2)
+
+# state of a learnParallel worker process: the memory-mapped data, the CPTs
+# and the columns each one learns from.  Set once when the worker starts so
+# tasks only have to carry a row range
+_worker = {}
+
+def _initWorker(path, cpts, slicers):
+    _worker['data']    = np.load(path, mmap_mode='r')
+    _worker['cpts']    = cpts
+    _worker['slicers'] = slicers
+
+# count tables of every CPT over rows start:stop of the shared data
+def _countRows(rowRange):
+    rows = _worker['data'][rowRange[0]:rowRange[1]]
+    return [ cpt._count(np.asarray(rows[:, cslice]))
+             for (cpt, cslice) in zip(_worker['cpts'], _worker['slicers']) ]
 
 class BayesNet:
     """Represents a Bayesian Network (or a joint distribution over CPTs)"""
@@ -8,6 +44,8 @@ class BayesNet:
     _vars     = []
     _domains  = []
     _cpts     = []
+    _plans    = {}  # compiled query plans keyed by query signature
+    _tables   = None  # per-CPT sampling tables (see _samplingTables)
 
     # takes list of variables and returns corresponding list of indicies
     def _indFromVar(self, variables):
@@ -40,33 +78,242 @@ class BayesNet:
         self._domains  = domains
         self._cpts     = [ CPT(conditional, self._domainFromVar(conditional))
                            for conditional in conditionals ]
+        self._plans    = {}
+        self._tables   = None
+
+    # make sure insts is a 2-D integer array of valid settings
+    def _checkInsts(self, insts):
+        insts = np.asarray(insts)
+        assert insts.ndim == 2 and insts.shape[1] == len(self._vars), (
+            "Instances should be a matrix with " + str(len(self._vars)) +
+            " columns")
+        assert np.issubdtype(insts.dtype, np.integer), (
+            "Values must all be integers!")
+        assert np.all((insts >= 0) & (insts < self._domains)), (
+            "Some values are not within correct domain!")
+        return insts
 
-    # insts is a list of lists each of which contains a setting for each of
-    # variables in this BayesNet
+    # the columns of the instances each CPT learns from
+    def _cptSlicers(self):
+        return [ self._indFromVar(cpt.getVars()) for cpt in self._cpts ]
+
+    # insts is a 2-D integer array (or a list of lists) with one row per
+    # instance holding a setting for each of the variables in this BayesNet
     def learn(self, insts):
+        insts = self._checkInsts(insts)
+        [ cpt.learn(insts[:, cslice])
+          for (cpt, cslice) in zip(self._cpts, self._cptSlicers()) ]
+        self._tables = None
+
+    # like learn, but adds to the counts learned so far instead of starting
+    # over, so only new data needs to be ingested
+    def partialFit(self, insts):
+        insts = self._checkInsts(insts)
+        [ cpt.partialFit(insts[:, cslice])
+          for (cpt, cslice) in zip(self._cpts, self._cptSlicers()) ]
+        self._tables = None
+
+    # learn from an iterable of chunks of instances (see npyChunks and
+    # csvChunks); memory stays bounded by the size of a chunk and the CPTs
+    def fitStream(self, chunks):
+        for chunk in chunks:
+            self.partialFit(chunk)
+        return self
+
+    # learn from an integer matrix saved with np.save at path, using a pool
+    # of nWorkers processes (all cores by default).  Every worker
+    # memory-maps the file, so rows are shared through the OS page cache
+    # instead of being pickled; each task counts chunkRows rows for every
+    # CPT and the parent adds the tables up (in row order, so the result
+    # does not depend on the number of workers)
+    def learnParallel(self, path, nWorkers=None, chunkRows=100000):
+        nRows   = np.load(path, mmap_mode='r').shape[0]
+        ranges  = [ (start, min(start + chunkRows, nRows))
+                    for start in range(0, nRows, chunkRows) ]
+
+        pool = Pool(nWorkers, _initWorker,
+                    (path, self._cpts, self._cptSlicers()))
+        try:
+            results = pool.map(_countRows, ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+        for i, cpt in enumerate(self._cpts):
+            cpt._counts = np.zeros(cpt._domains)
+            cpt._addCounts(sum([ counts[i] for counts in results ]))
+        self._tables = None
+
+    # add the counts of another BayesNet with the same structure (e.g. one
+    # trained on a different shard of data) to this one; returns self
+    def merge(self, other):
+        assert len(self._cpts) == len(other._cpts), (
+            "Can only merge BayesNets with the same structure!")
+        [ cpt.merge(o) for (cpt, o) in zip(self._cpts, other._cpts) ]
+        self._tables = None
+        return self
+
+    # ancestors of vs (including vs themselves)
+    def _ancestors(self, vs):
+        parents = dict([ (cpt.getVars()[0], cpt.getVars()[1:])
+                         for cpt in self._cpts ])
+        seen, stack = set(), list(vs)
+        while stack:
+            v = stack.pop()
+            if v not in seen:
+                seen.add(v)
+                stack.extend(parents[v])
+        return seen
+
+    # compile a query: prune barren nodes (keep only ancestors of the
+    # targets and evidence), cut the edges leaving evidence nodes and drop
+    # everything no longer connected to the targets (it is d-separated from
+    # them).  Returns the indices of the CPTs that matter and a greedy
+    # (min-fill) order in which to eliminate their non-target variables
+    def _plan(self, targets, evidenceVars):
+        relevant = self._ancestors(list(targets) + list(evidenceVars))
+        nbrs     = dict([ (v, set()) for v in relevant ])
+        for cpt in self._cpts:
+            child = cpt.getVars()[0]
+            if child not in relevant:
+                continue
+            for parent in cpt.getVars()[1:]:
+                if parent not in evidenceVars:
+                    nbrs[child].add(parent)
+                    nbrs[parent].add(child)
+
+        connected, stack = set(), list(targets)
+        while stack:
+            v = stack.pop()
+            if v not in connected:
+                connected.add(v)
+                stack.extend(nbrs[v])
+
+        kept    = [ i for i, cpt in enumerate(self._cpts)
+                    if cpt.getVars()[0] in connected ]
+        scopes  = [ [ v for v in self._cpts[i].getVars()
+                      if v not in evidenceVars ] for i in kept ]
+        allVars = set([ v for scope in scopes for v in scope ])
+        domains = dict([ (v, self._domains[self._vars2ind[v]])
+                         for v in allVars ])
+        order, _ = eliminationOrder(scopes, domains, 'minfill',
+                                    allVars - set(targets))
+        return kept, order
+
+    # P(targets | evidence) by variable elimination.  targets is a list of
+    # variables and evidence a dictionary mapping variables to their
+    # observed values.  Plans are cached by the targets and the evidence
+    # variables, so repeated queries of the same shape skip planning.
+    # Returns a Factor of probabilities over the targets (in that order)
+    def query(self, targets, evidence=None):
+        if evidence is None:
+            evidence = {}
+        for v in list(targets) + list(evidence.keys()):
+            assert v in self._vars2ind, "Unknown variable: " + str(v)
+        assert not set(targets) & set(evidence.keys()), (
+            "Targets can't also be evidence!")
+
+        signature = (tuple(targets), tuple(sorted(evidence.keys())))
+        if signature not in self._plans:
+            self._plans[signature] = self._plan(targets, set(evidence.keys()))
+        kept, order = self._plans[signature]
+
+        factors = []
+        for i in kept:
+            factor = self._cpts[i].toFactor()
+            for v in factor.varOrdering():
+                if v in evidence:
+                    factor = factor.observe(v, evidence[v])
+            factors.append(factor)
+
+        for var in order:
+            bucket  = [ f for f in factors if var in f.varOrdering() ]
+            factors = [ f for f in factors if var not in f.varOrdering() ]
+            factors.append(Factor.product(bucket).eliminate([var]))
+
+        joint = Factor.product(factors).toProbs()
+        perm  = [ joint.varOrdering().index(v) for v in targets ]
+        return Factor(targets, self._domainFromVar(targets),
+                      np.transpose(joint._factor, perm))
+
+    # CPTs in topological order (every parent's CPT before its children's)
+    def _topologicalCPTs(self):
+        done, ordered, remaining = set(), [], list(self._cpts)
+        while remaining:
+            ready = [ c for c in remaining if set(c.getVars()[1:]) <= done ]
+            assert len(ready) > 0, "The network has a cycle!"
+            for c in ready:
+                done.add(c.getVars()[0])
+                ordered.append(c)
+            remaining = [ c for c in remaining if c not in ready ]
+        return ordered
 
-        # quick function for getting relevant indices from instance
-        def instSlice(indices, inst):
-            return [ inst[i] for i in indices ]
+    # for every CPT in topological order: its columns, its table with the
+    # child axis moved last (so each row belongs to one parent setting) and
+    # the cumulative sums along those rows.  Built on first use and kept
+    # until the CPTs are learned again
+    def _samplingTables(self):
+        if self._tables is None:
+            self._tables = []
+            for cpt in self._topologicalCPTs():
+                table = np.reshape(np.moveaxis(cpt._probs, 0, -1),
+                                   (-1, cpt._domains[0]))
+                self._tables.append((cpt, self._indFromVar(cpt.getVars()),
+                                     table, np.cumsum(table, axis=1)))
+        return self._tables
 
-        for inst in insts:
-            assert len(inst) == len(self._vars), (
-                "Instance " + str(inst) + " should be of length " +
-                str(len(self.vars)))
+    # fill in the columns of samples (n x len(vars)) in topological order,
+    # one vectorized categorical draw per CPT: the parents' flat index picks
+    # the row of the CPT's cumulative table to compare uniform draws from
+    # rng against.  Evidence variables are clamped instead of drawn; returns
+    # the log-likelihood of the evidence of each sample (the
+    # likelihood-weighting weights)
+    def _ancestralSample(self, samples, evidence, rng):
+        n          = samples.shape[0]
+        logWeights = np.zeros(n)
+        for cpt, cols, table, cum in self._samplingTables():
+            if len(cols) > 1:
+                rows = np.ravel_multi_index(tuple(samples[:, cols[1:]].T),
+                                            cpt._domains[1:])
+            else:
+                rows = np.zeros(n, dtype=int)
 
-            for i,v in enumerate(inst):
-                assert v >= 0 and v < self._domains[i], (
-                    "Value " + str(v) + " is not within correct domain!")
+            child = cpt.getVars()[0]
+            if child in evidence:
+                samples[:, cols[0]] = evidence[child]
+                with np.errstate(divide='ignore'):
+                    logWeights += np.log(table[rows, evidence[child]])
+            else:
+                draws = np.sum(rng.random((n, 1)) > cum[rows], axis=1)
+                samples[:, cols[0]] = np.minimum(draws, table.shape[1] - 1)
+        return logWeights
 
-        # Get relevant indicies for each CPT
-        cptSlicers = [ self._indFromVar(cpt.getVars()) for cpt in self._cpts ]
+    # draw n joint samples; returns an (n x len(vars)) integer array with
+    # one column per variable (the same layout learn takes).  seed is a seed
+    # (or a numpy Generator) for the random draws
+    def sample(self, n, seed=None):
+        samples = np.zeros((n, len(self._vars)), dtype=int)
+        self._ancestralSample(samples, {}, np.random.default_rng(seed))
+        return samples
 
-        # Build a list of instances for each CPT to learn by slicing out
-        # the correct incides from each training instance
-        learningSets = [[ instSlice(cslice, inst) for inst in insts ]
-                        for cslice in cptSlicers ]
+    # approximate P(query | evidence) from n likelihood-weighted samples.
+    # query is a list of variables and evidence a dictionary mapping
+    # variables to their observed values; returns a Factor of probabilities
+    # over the query variables (like query).  seed is as for sample
+    def likelihoodWeighting(self, query, evidence, n, seed=None):
+        samples    = np.zeros((n, len(self._vars)), dtype=int)
+        logWeights = self._ancestralSample(samples, evidence,
+                                           np.random.default_rng(seed))
+        assert np.any(logWeights > -np.inf), "Every sample has weight 0!"
 
-        [ cpt.learn(x) for (cpt, x) in zip(self._cpts, learningSets) ]
+        domains = self._domainFromVar(query)
+        cells   = np.ravel_multi_index(
+            tuple(samples[:, self._indFromVar(query)].T), domains)
+        weights = np.bincount(cells, weights=np.exp(logWeights -
+                                                    logWeights.max()),
+                              minlength=np.prod(domains))
+        return Factor(query, domains,
+                      np.reshape(weights / weights.sum(), domains))
 
     def showJoint(self):
         lval = "P(" + ",".join(self._vars) + ")"
@@ -1,6 +1,5 @@
 import numpy as np
-from   numpy import cumprod
-from   numpy import array
+from   Factor import Factor
 
 class CPT:
     """Represents a conditional probability table over a set of discrete
@@ -11,7 +10,8 @@ class CPT:
     _vars2inds   = {}  # maps variables to indicies; index 0 is the child
     _vars        = []  # we must maintain the invariant that:
     _domains     = []  #    dom(vars[i]) == domains[i] and that
-    _probs       = []  # probabilities of various variable configurations
+    _probs       = []  # N-d array of probabilities; axis i is _vars[i]
+    _counts      = []  # raw counts the probabilities are estimated from
 
     # THINK ABOUT THIS CONSTRUCTOR
     # pass in 2 dictionaries; each one maps variable names to number of
@@ -33,40 +33,71 @@ class CPT:
             assert int(d) == d, ("Domains must all be integers!")
 
         self._domains = domains
-        self._probs   = np.zeros(np.product(self._domains))
+        self._probs   = np.zeros(self._domains)
+        self._counts  = np.zeros(self._domains)
         self._vars    = variables
         self._vars2inds = dict([ (pair[1], pair[0])
                                  for pair in enumerate(variables) ])
 
-    # make sure that a particular setting of the variables checks out
-    def _assertSetting(self, setting, domain):
-        assert len(setting) == len(domain)
-        for i,e in enumerate(setting):
-            assert e >= 0,        "All values must be >= 0!"
-            assert e < domain[i], "All values must be < domain!"
-            assert int(e) == e,   "Settings must all be integers!"
-
-    # setting is a list of settings. ORDER MATTERS! The ordering must be
-    # the same ordering as the ordering of both _domains and _vars
-    def _setting2Index(self, setting):
-        offsetsArray = np.append(1, cumprod(self._domains))
-        offsetsArray = offsetsArray.take(range(0,len(self._domains)))
-        return np.dot(array(setting),offsetsArray)
-
-    # return the probability of a particular setting
+    # make sure that every row of an (N x len(domain)) matrix is a valid
+    # setting of the variables
+    def _assertSettings(self, settings, domain):
+        assert settings.ndim == 2 and settings.shape[1] == len(domain), (
+            "Settings must be a matrix with one column per variable!")
+        assert np.issubdtype(settings.dtype, np.integer), (
+            "Settings must all be integers!")
+        assert np.all(settings >= 0),     "All values must be >= 0!"
+        assert np.all(settings < domain), "All values must be < domain!"
+
+    # return the probability of a particular setting.  ORDER MATTERS! The
+    # ordering must be the same ordering as the ordering of _vars
     def probs(self, setting):
-        return self._probs[self._setting2Index(setting)]
-
-    # examples is a list of settings of the parameter (each setting is itself
-    # a list.  Fill in the probability table in the internal CPT
+        return self._probs[tuple(setting)]
+
+    # probabilities of many settings at once: settings is a 2-D array (or
+    # list of lists) with one setting per row
+    def bulkProbs(self, settings):
+        settings = np.reshape(np.asarray(settings), (-1, len(self._domains)))
+        self._assertSettings(settings, self._domains)
+        return self._probs[tuple(settings.T)]
+
+    # examples is a 2-D integer array (or list of lists) with one setting of
+    # the variables per row.  Fill in the probability table in the internal
+    # CPT, throwing away anything learned before
     def learn(self, examples):
-        for ex in examples:
-            self._assertSetting(ex, self._domains)
-
-        self._probs = np.zeros(np.product(self._domains))
-        for ex in examples:
-            self._probs[self._setting2Index(ex)] += 1
-
+        self._counts = np.zeros(self._domains)
+        self.partialFit(examples)
+
+    # like learn, but adds the counts of examples to the counts already
+    # seen so a CPT can be trained one chunk of data at a time
+    def partialFit(self, examples):
+        self._addCounts(self._count(examples))
+
+    # add the counts of another CPT over the same variables (e.g. one trained
+    # on a different chunk of data) to this one; returns self
+    def merge(self, other):
+        assert list(self._vars) == list(other._vars), (
+            "Can only merge CPTs over the same variables!")
+        assert list(self._domains) == list(other._domains), (
+            "Can only merge CPTs with the same domains!")
+        self._addCounts(other._counts)
+        return self
+
+    # count how many times each setting appears in examples (one bincount)
+    # without touching this CPT
+    def _count(self, examples):
+        examples = np.reshape(np.asarray(examples), (-1, len(self._domains)))
+        self._assertSettings(examples, self._domains)
+
+        indices = np.ravel_multi_index(tuple(examples.T), self._domains)
+        return np.reshape(np.bincount(indices,
+                                      minlength=np.prod(self._domains)),
+                          self._domains)
+
+    # add a table of counts and re-estimate the probabilities from them
+    def _addCounts(self, counts):
+        self._counts = self._counts + counts
+        self._probs  = self._counts.copy()
         self._normalizeCPT()
 
     # return a CPT that represents the corrent CPT marginalized over the
@@ -77,51 +108,36 @@ class CPT:
         assert set(toKeep).issubset(self._vars), (
             "Some variables passed in do not appear in this conditional!")
 
-        keptInds = []
-        [ keptInds.append(self._vars2inds[v]) for v in toKeep ]
-        sKept = sorted(keptInds)
+        sKept   = sorted([ self._vars2inds[v] for v in toKeep ])
+        dropped = tuple(i for i in range(len(self._vars)) if i not in sKept)
         cpt = CPT([ self._vars[ind]    for ind in sKept ],
                   [ self._domains[ind] for ind in sKept ])
 
-        allSettings = self._enumerateSettings(self._domains)
-        for setting in allSettings:
-            adjusted = [ setting[ind] for ind in sKept ]
-            cpt._probs[cpt._setting2Index(adjusted)] += self.probs(setting)
-
+        cpt._probs = np.reshape(np.sum(self._probs, axis=dropped),
+                                cpt._domains)
         cpt._normalizeCPT()
         return cpt
 
-    def _normalizeArray(self, a):
-        return a / float(sum(a))
-
     # normalize this CPT: for every configuartion of the parents, the
     # sum of the probabilities of changing the child setting is 1
     def _normalizeCPT(self):
-        splitSize = np.product(self._domains) / self._domains[0]
-        splits    = np.split(self._probs, splitSize)
-        # splits now contains arrays of size _domains[0] that we'll normalize
+        self._probs = self._probs / np.sum(self._probs, axis=0, keepdims=True)
 
-        normalized  = array([ self._normalizeArray(a) for a in splits ])
-        self._probs = normalized.flatten()
-
-    # create list of settings of variables with the following domains
-    # this is a GROSS function
+    # create list of settings of variables with the following domains (the
+    # first variable changes fastest)
     def _enumerateSettings(self, domains):
-        numRows   = np.product(domains)
-        numRepeat = 1
-        numTile   = numRows
-        rows = []
-        for d in domains:
-            numTile /= d
-            row = np.tile(array(range(d)).repeat(numRepeat), numTile)
-            numRepeat *= d
-            rows.append(row)
-
-        return array(rows).transpose()
+        return np.reshape(np.indices(domains), (len(domains), -1),
+                          order='F').transpose()
 
     def getVars(self):
         return self._vars
 
+    # return this CPT as a log-space Factor over the same variables
+    def toFactor(self):
+        with np.errstate(divide='ignore'):
+            logProbs = np.log(self._probs)
+        return Factor(self._vars, self._domains, logProbs)
+
     # Return a visual representation of the conditional disribution
     # represented by this CPT
     def getConditional(self):
@@ -138,7 +154,7 @@ class CPT:
         print(" ".join([str(x) for x in self._vars]) +
               " " + self.getConditional())
 
-        for i,e in enumerate(settings):
+        for e in settings:
             setting = [int(x) for x in e.tolist()]
-            setting.append(self._probs[i])
+            setting.append(self._probs[tuple(setting)])
             print("|".join([str(x) for x in setting]))
@@ -1,4 +1,4 @@
-from   factor import Factor
+from   Factor import Factor
 import numpy  as     np
 
 class CliqueChain:
@@ -21,20 +21,21 @@ class CliqueChain:
         message = f1.eliminate(f1vars - sepset)
         return message
 
+    # returns the list of messages passed along cliques (in the order given)
+    def _passMessages(self, cliques):
+        messages = [ self.message(cliques[0], cliques[1]) ]
+        for i in range(1, len(cliques) - 1):
+            updatedClique = cliques[i].add(messages[i-1])
+            messages.append(self.message(updatedClique, cliques[i + 1]))
+        return messages
+
     # returns a list of messages from C1 -> C2, C2 -> C3, etc.
     def forwardMessages(self):
-        messages = [ self.message(self._cliques[0], self._cliques[1]) ]
-        for i in range(1, len(self._cliques) - 1):
-            updatedClique = self._cliques[i].add(messages[i-1])
-            messages.append(self.message(updatedClique, self._cliques[i + 1]))
-        return messages
+        return self._passMessages(self._cliques)
 
     # returns a list of message from Cn -> Cn-1, Cn-1 -> Cn-2, etc...
     def backwardMessages(self):
-        self._cliques.reverse()
-        messages = self.forwardMessages()
-        self._cliques.reverse()
-        return messages
+        return self._passMessages(self._cliques[::-1])
 
     # returns cluster beliefs
     def sumProduct(self):
@@ -52,6 +53,46 @@ class CliqueChain:
 
         return beliefs
 
+    # max-product counterpart of message: maximize (instead of summing) the
+    # variables of the belief that aren't in the sepset.  Also returns a
+    # backpointer: the sepset variables, the variables maximized out, their
+    # domains and, for every setting of the sepset, the flat index of the
+    # best setting of the maximized variables
+    def _maxMessage(self, belief, sepset):
+        keep    = [ v for v in belief._vars if v in sepset ]
+        elim    = [ v for v in belief._vars if v not in sepset ]
+        keepDom = [ belief._domain(v) for v in keep ]
+        elimDom = [ belief._domain(v) for v in elim ]
+        table   = np.transpose(belief._factor,
+                               [ belief._vars.index(v) for v in keep + elim ])
+        table   = np.reshape(table, keepDom + [ -1 ])
+        message = Factor(keep, keepDom, table.max(axis=-1))
+        return message, (keep, elim, elimDom, table.argmax(axis=-1))
+
+    # MAP decoding (Viterbi): a forward pass of max-product messages that
+    # records backpointers, then a backward pass that follows them.  Returns
+    # the best assignment (a dictionary like the one logLikelihood takes)
+    # and its unnormalized log score; subtract logZ() for its log-likelihood
+    def maxProduct(self):
+        belief, backptrs = self._cliques[0], []
+        for nxt in self._cliques[1:]:
+            sepset = set(belief._vars).intersection(set(nxt._vars))
+            message, backptr = self._maxMessage(belief, sepset)
+            backptrs.append(backptr)
+            belief = nxt.add(message)
+
+        best       = np.unravel_index(np.argmax(belief._factor),
+                                      belief._factor.shape)
+        assignment = dict(zip(belief._vars, [ int(x) for x in best ]))
+        score      = belief._factor[best]
+
+        for (keep, elim, elimDom, argmaxes) in reversed(backptrs):
+            sepVals = tuple(assignment[v] for v in keep)
+            best    = np.unravel_index(argmaxes[sepVals], elimDom)
+            assignment.update(zip(elim, [ int(x) for x in best ]))
+
+        return assignment, score
+
     # returns marginals over all variables in the model as a dictionary
     # whose keys are the variable names
     def allMarginals(self):
@@ -64,11 +105,130 @@ class CliqueChain:
         return dict([ (var, b.marginal([var]).toProbs())
                       for (var,b) in vars2beliefs.items() ])
 
+    # log of the partition function from one forward pass of messages
+    def logZ(self):
+        if len(self._cliques) == 1:
+            return self._cliques[0].logZ()
+        return self._cliques[-1].add(self.forwardMessages()[-1]).logZ()
+
     # pass in an assignment and return the corresponding log-likelihood
     # the assignment should be a dictionary mapping each variable to a number
-    # in the domain of that variable
-    # this function might not be feasible if the chain is really long because
-    # you could end up with a huge tensor in memory
+    # in the domain of that variable.  The assignment is scored clique by
+    # clique so nothing bigger than a clique is ever built
     def logLikelihood(self, assignment):
-        joint = reduce(lambda f1,f2: f1.add(f2), self._cliques)
-        return joint.get(assignment) - joint.logZ()
+        self._assertFullAssignment(assignment)
+        score = sum([ c.get(dict([ (v, assignment[v]) for v in c._vars ]))
+                      for c in self._cliques ])
+        return score - self.logZ()
+
+    # log-likelihoods of many assignments (a list of dictionaries as above);
+    # each clique scores all of them with one fancy-indexing lookup and logZ
+    # is computed once
+    def logLikelihoods(self, assignments):
+        for assignment in assignments:
+            self._assertFullAssignment(assignment)
+        scores = np.zeros(len(assignments))
+        for c in self._cliques:
+            index   = tuple(np.array([ a[v] for a in assignments ], dtype=int)
+                            for v in c._vars)
+            scores += c._factor[index]
+        return scores - self.logZ()
+
+    def _assertFullAssignment(self, assignment):
+        allVars = set()
+        for c in self._cliques:
+            allVars.update(c._vars)
+        assert set(assignment.keys()) == allVars, (
+            "Assignment/Joint variables must match!")
+
+
+class CalibratedChain(CliqueChain):
+    """
+    A clique chain that keeps its forward/backward messages and beliefs
+    between queries.  Changing a clique potential (setPotential) or adding
+    evidence (observe) only marks the messages downstream of the change as
+    stale, and the next query recomputes just those
+    """
+
+    def __init__(self, cliques):
+        CliqueChain.__init__(self, list(cliques))
+        n = len(self._cliques)
+        self._fwd     = [ None ] * (n - 1)  # _fwd[i] is C_i -> C_i+1
+        self._bwd     = [ None ] * (n - 1)  # _bwd[i] is C_i+1 -> C_i
+        self._beliefs = [ None ] * n
+
+    # cliques lo..hi changed: forward messages leaving cliques >= lo and
+    # backward messages leaving cliques <= hi are stale, and so is every
+    # belief
+    def _invalidate(self, lo, hi):
+        for i in range(lo, len(self._fwd)):
+            self._fwd[i] = None
+        for i in range(0, min(hi, len(self._bwd))):
+            self._bwd[i] = None
+        self._beliefs = [ None ] * len(self._cliques)
+
+    # forward message C_i -> C_i+1, recomputing stale ones up to i
+    def _forward(self, i):
+        start = i
+        while start > 0 and self._fwd[start - 1] is None:
+            start -= 1
+        for j in range(start, i + 1):
+            if self._fwd[j] is None:
+                clique = self._cliques[j]
+                if j > 0:
+                    clique = clique.add(self._fwd[j - 1])
+                self._fwd[j] = self.message(clique, self._cliques[j + 1])
+        return self._fwd[i]
+
+    # backward message C_i+1 -> C_i, recomputing stale ones down to i
+    def _backward(self, i):
+        last = len(self._bwd) - 1
+        start = i
+        while start < last and self._bwd[start + 1] is None:
+            start += 1
+        for j in range(start, i - 1, -1):
+            if self._bwd[j] is None:
+                clique = self._cliques[j + 1]
+                if j < last:
+                    clique = clique.add(self._bwd[j + 1])
+                self._bwd[j] = self.message(clique, self._cliques[j])
+        return self._bwd[i]
+
+    # replace the potential of the i-th clique
+    def setPotential(self, i, factor):
+        self._cliques[i] = factor
+        self._invalidate(i, i)
+
+    # add evidence var = val to every clique that touches var
+    def observe(self, var, val):
+        touched = [ i for i, c in enumerate(self._cliques) if var in c._vars ]
+        assert len(touched) > 0, "No clique touches " + str(var)
+        for i in touched:
+            self._cliques[i] = self._cliques[i].observe(var, val)
+        self._invalidate(min(touched), max(touched))
+
+    # calibrated belief of the i-th clique
+    def belief(self, i):
+        if self._beliefs[i] is None:
+            belief = self._cliques[i]
+            if i > 0:
+                belief = belief.add(self._forward(i - 1))
+            if i < len(self._bwd):
+                belief = belief.add(self._backward(i))
+            self._beliefs[i] = belief
+        return self._beliefs[i]
+
+    # returns cluster beliefs
+    def sumProduct(self):
+        return [ self.belief(i) for i in range(len(self._cliques)) ]
+
+    # returns the marginal probabilities of a single variable
+    def marginal(self, var):
+        for i, c in enumerate(self._cliques):
+            if var in c._vars:
+                return self.belief(i).marginal([var]).toProbs()
+        assert False, "No clique touches " + str(var)
+
+    # log of the partition function (of the evidence, once observed)
+    def logZ(self):
+        return self.belief(len(self._cliques) - 1).logZ()
@@ -1,86 +1,98 @@
-import copy
 import numpy as np
-from scipy.misc import logsumexp
+from scipy.special import logsumexp
 
-class Factor:
+class Factor(object):
     """
     Represents a general log factor in any type of factor graph
     """
-    # make sure we have the ordering correct (this is CRUCIAL!)
-    def _assertOrdering(self):
-        for var,ind in self._vars2inds.iteritems():
-            assert self._vars[ind] == var , "Incorrect internal ordering!"
+    # variables are a tuple and domains an int array that are kept IN THE SAME
+    # ORDER as the axes of the tensor; _assigned is a tuple of (var, val)
+    # pairs.  Factors derived by slicing share their tensor with the factor
+    # they came from (_shared) until one of them is written to
+    __slots__ = ('_vars', '_domains', '_factor', '_assigned', '_shared')
+
+    # number of leading batch axes in front of the variable axes (see
+    # BatchedFactor)
+    _NBATCH = 0
 
     def _assertVarExists(self, v):
-        assert self._vars2inds.has_key(v), "Factor doesn't touch " + str(v)
+        assert v in self._vars, "Factor doesn't touch " + str(v)
 
     def _assertTuple(self,t):
         assert type(t) is tuple, "must pass in a tuple"
 
     def _assertValWithinDomain(self, var, val):
         self._assertVarExists(var)
-        assert self._domains[var] > val, (
+        assert self._domain(var) > val, (
             str(val) + " is outside the valid domain of var: " + str(var))
 
     def _assertCorrectDimensionality(self):
-        for var, ind in self._vars2inds.iteritems():
-            assert self._factor.shape[ind] == self._domains[var], (
-                "Incorrect dimensionality")
+        assert self._factor.shape[self._NBATCH:] == tuple(self._domains), (
+            "Incorrect dimensionality")
+
+    # build a factor straight from internal state, skipping the checks done
+    # in the constructor
+    @classmethod
+    def _new(cls, variables, domains, factor, assigned=(), shared=False):
+        newFactor = object.__new__(cls)
+        newFactor._vars     = variables
+        newFactor._domains  = domains
+        newFactor._factor   = factor
+        newFactor._assigned = assigned
+        newFactor._shared   = shared
+        return newFactor
 
     # return a copy of this factor
     def _copy(self):
-        return Factor(copy.copy(self._vars),
-                      self._domains.values(),
-                      np.copy(self._factor))
-
-    # swap dimensions SAFELY keeping all internal state correct (aka vars,
-    # vars2inds, and factor itself
-    def _safeDimSwap(self, frm, to):
-        if frm == to:
-            return
-
-        frmVar, toVar = self._vars[frm], self._vars[to]
-        frmDom, toDom = self._domains[frmVar], self._domains[toVar]
-
-        self._vars[frm], self._vars[to] = self._vars[to], self._vars[frm]
-        self._vars2inds.update({ frmVar : to, toVar : frm})
-        self._domains.update({ frmVar : toDom, toVar : frmDom })
-        self._factor = np.swapaxes(self._factor, frm, to)
-        self._assertCorrectDimensionality()
-        self._assertOrdering()
-
-    # safely add a dimension to the factor keeping track of all internal state
-    def _safeDimAdd(self, var, ind):
-        self._factor = np.expand_dims(self._factor, ind)
-        self._vars.insert(ind, var)
-        self._domains[var] = 1
-        for v,i in self._vars2inds.iteritems():
-            if i>= ind:
-                self._vars2inds.update({v : i + 1})
-        self._assertCorrectDimensionality()
-        self._assertOrdering()
+        return self._new(self._vars, self._domains.copy(),
+                         np.copy(self._factor), self._assigned)
+
+    # return a factor that shares (a view of) this factor's tensor; both
+    # factors will copy before their next write
+    def _view(self, variables, domains, factor, assigned):
+        self._shared = True
+        return self._new(variables, domains, factor, assigned, True)
+
+    # make sure we own our tensor before writing to it
+    def _writable(self):
+        if self._shared:
+            self._factor = np.copy(self._factor)
+            self._shared = False
+
+    def _index(self, var):
+        self._assertVarExists(var)
+        return self._vars.index(var)
+
+    def _domain(self, var):
+        return self._domains[self._index(var)]
+
+    # the indices of the tensor axes belonging to vs (unknown vars are
+    # skipped), the variables left over and their domains
+    def _split(self, vs):
+        vs   = set(vs)
+        axes = tuple(i + self._NBATCH
+                     for i,v in enumerate(self._vars) if v in vs)
+        keep = [ i for i,v in enumerate(self._vars) if v not in vs ]
+        return axes, tuple(self._vars[i] for i in keep), self._domains[keep]
 
-    # After eliminating a var, reorganize indicies correctly by
-    # subtracting 1 from indicies that are greater
-    def _resetIndicies(self, index):
-        for var, ind in self._vars2inds.iteritems():
-            if ind > index:
-                self._vars2inds.update({var : ind - 1})
+    # the tensor with var fixed to val (a view)
+    def _sliced(self, var, val):
+        self._assertValWithinDomain(var,val)
+        dim   = self._index(var)
+        index = [ slice(None) ] * self._factor.ndim
+        index[dim + self._NBATCH] = val
+        return dim, self._factor[tuple(index)]
 
-    # It's a bit weird here that you pass in a list for domains and it gets
-    # converted to a dictionary...especially because variables is a dict
     # ALSO MAKE SURE THAT factor THAT IS PASSED IN IS IN LOG-SPACE!
     def __init__(self, variables, domains, factor):
-        # make some assertions here
-        self._factor    = factor
-        self._vars      = variables
-        self._domains   = {}
-        self._vars2inds = {}
-        self._assigned  = {}
-        for i,v in enumerate(variables):
-            self._vars2inds[v] = i
-            self._domains[v] = domains[i]
-        self._assertOrdering()
+        assert len(set(variables)) == len(variables), "Duplicate variables!"
+        assert len(variables) == len(domains), (
+            "Number of variables and number of domain entries do not match!")
+        self._factor   = factor
+        self._vars     = tuple(variables)
+        self._domains  = np.array(domains, dtype=int)
+        self._assigned = ()
+        self._shared   = False
         self._assertCorrectDimensionality()
 
     # get current ordering of the variables
@@ -91,6 +103,7 @@ class Factor:
     def set(self, setting, value):
         # make some assertions here
         self._assertTuple(setting)
+        self._writable()
         self._factor[setting] = value
 
     # assignment is a dictionary that maps variables to indicies
@@ -98,7 +111,7 @@ class Factor:
     def get(self, assignment):
         assert set(assignment.keys()) == set(self._vars), (
             "Assignment/Joint variables must match!")
-        for var, val in assignment.iteritems():
+        for var, val in assignment.items():
             self._assertValWithinDomain(var, val)
 
         index   = [ assignment[v] for v in self._vars ]
@@ -107,89 +120,143 @@ class Factor:
     # visual representation
     def show(self):
         assigned = []
-        for var, assignment in self._assigned.iteritems():
+        for var, assignment in self._assigned:
             assigned.append(str(var) + " = " + str(assignment))
-        return "F(" + ",".join(self._vars + assigned) + ")"
+        return "F(" + ",".join([str(v) for v in self._vars] + assigned) + ")"
 
-    # log-factor add (factor multiply)
-    # strategy: 1) get the tensors to be the same dimensions using expand_dims
-    #           2) make sure that the dimension ordering is the same for both
-    #           3) broadcast the multiplication
-    # (right now too complex)
-    def add(self, newFactor):
-        myFactorCopy  = self._copy()
-        newFactorCopy = newFactor._copy()
-        newVars = list(set(myFactorCopy._vars).union(set(newFactorCopy._vars)))
-
-        for ind, var in enumerate(newVars):
-            for factor in [myFactorCopy, newFactorCopy]:
-                if factor._vars2inds.has_key(var):
-                    factor._safeDimSwap(factor._vars2inds[var], ind)
+    # return a view of this factor's tensor laid out along `ordering` (which
+    # must contain every variable of this factor) behind nbatch batch axes.
+    # Variables (and batch axes) this factor doesn't have get an axis of
+    # length 1 so the view broadcasts; no data is copied
+    def _alignedTo(self, ordering, nbatch=0):
+        nb    = self._NBATCH
+        perm  = sorted(range(len(self._vars)),
+                       key=lambda i: ordering.index(self._vars[i]))
+        perm  = list(range(nb)) + [ i + nb for i in perm ]
+        lead  = (1,) * (nbatch - nb) + self._factor.shape[:nb]
+        shape = [ self._domain(v) if v in self._vars else 1
+                  for v in ordering ]
+        return np.transpose(self._factor, perm).reshape(lead + tuple(shape))
+
+    # reshape a per-batch quantity (e.g. logZ) so it broadcasts against
+    # this factor's tensor
+    def _perBatch(self, x):
+        return np.reshape(x, np.shape(x) + (1,) * len(self._vars))
+
+    # work out the output layout of a product once: the union of the
+    # variables in the order they are first seen and their domains
+    @staticmethod
+    def _productLayout(factors):
+        ordering, domains = [], []
+        for f in factors:
+            for v, d in zip(f._vars, f._domains):
+                if v in ordering:
+                    assert domains[ordering.index(v)] == d, (
+                        "Domain mismatch for var: " + str(v))
                 else:
-                    factor._safeDimAdd(var, ind)
+                    ordering.append(v)
+                    domains.append(d)
+        return ordering, domains
+
+    # log-factor product of any number of factors in one pass.  If any of
+    # the factors is batched, so is the result (unbatched factors are
+    # broadcast over the batch)
+    # strategy: 1) compute the output variable ordering once
+    #           2) align each tensor to it with a single broadcastable view
+    #           3) sum the views (log space, so summing == multiplying)
+    @staticmethod
+    def product(factors):
+        assert len(factors) > 0, "Must pass in at least one factor"
+        # other representations (e.g. SparseFactor) are folded in with their
+        # own add once the dense operands have been multiplied together
+        others = [ f for f in factors if not isinstance(f, Factor) ]
+        if others:
+            dense = [ f for f in factors if isinstance(f, Factor) ]
+            if dense:
+                others.append(Factor.product(dense))
+            result = others[0]
+            for f in others[1:]:
+                result = result.add(f)
+            return result
+        ordering, domains = Factor._productLayout(factors)
+        top     = max(factors, key=lambda f: f._NBATCH)
+        cls     = top.__class__
+        batch   = top._factor.shape[:top._NBATCH]
+        aligned = [ f._alignedTo(ordering, cls._NBATCH) for f in factors ]
 
-        _newFactor =  myFactorCopy._factor + newFactorCopy._factor
-        return Factor(newVars, list(_newFactor.shape), _newFactor)
+        _newFactor      = np.empty(batch + tuple(domains))
+        _newFactor[...] = aligned[0]
+        for a in aligned[1:]:
+            _newFactor += a
+        return cls._new(tuple(ordering), np.array(domains, dtype=int),
+                        _newFactor)
 
-    # observe a single variable; updates vars, vars2inds, domains and
-    # adds an entry to assignment
-    # NEEDS ASSERTIONS AND MORE CHECKING
+    # log-factor add (factor multiply); other factor representations (e.g.
+    # SparseFactor) know how to add a dense Factor to themselves
+    def add(self, newFactor):
+        if not isinstance(newFactor, Factor):
+            return newFactor.add(self)
+        return Factor.product([self, newFactor])
+
+    # observe a single variable; the returned factor shares this factor's
+    # tensor (no copy is made until one of them is written to)
     def observe(self, var, val):
-        newFactor = self._copy()
-        newFactor._assertVarExists(var)
-        newFactor._assertValWithinDomain(var,val)
-        dim = newFactor._vars2inds.pop(var)
-        newFactor._domains.pop(var)
-        newFactor._vars.pop(dim)
-        newFactor._assigned[var] = val
-        newFactor._safeDimSwap(dim, 0)
-        newFactor._factor = newFactor._factor[val,:]
-        return newFactor
+        dim, sliced = self._sliced(var, val)
+        return self._view(self._vars[:dim] + self._vars[dim + 1:],
+                          np.delete(self._domains, dim),
+                          sliced,
+                          self._assigned + ((var, val),))
 
-    # variable elimination; eliminates a single variable and does all
-    # necessary state checking;
-    # change this so that it works IN PLACE (impure) so it doesn't blow stack
-    def _eliminate(self, var):
-        newFactor = self._copy()
-        if set([var]).issubset(set(newFactor._vars)):
-            varInd = newFactor._vars2inds.pop(var)
-            newFactor._domains.pop(var)
-            newFactor._vars.pop(varInd)
-            newFactor._factor = logsumexp(newFactor._factor, varInd)
-            newFactor._resetIndicies(varInd)
-            newFactor._assertCorrectDimensionality()
-            newFactor._assertOrdering()
-        return newFactor
+    # in-place version of observe; returns self
+    def observeInPlace(self, var, val):
+        dim, sliced = self._sliced(var, val)
+        self._vars      = self._vars[:dim] + self._vars[dim + 1:]
+        self._domains   = np.delete(self._domains, dim)
+        self._factor    = sliced
+        self._assigned += ((var, val),)
+        return self
 
-    # pass in a list of vars to be elimated and call eliminate on each in turn
+    # variable elimination; eliminates all of the vars passed in (ignoring
+    # any this factor doesn't touch) with a single logsumexp over their axes
     def eliminate(self, vs):
-        if len(vs) == 0:
+        axes, vs, domains = self._split(vs)
+        if len(axes) == 0:
             return self
-        else:
-            newFactor = self._eliminate(vs.pop())
-            return newFactor.eliminate(vs)
+        return self._new(vs, domains,
+                         np.asarray(logsumexp(self._factor, axis=axes)),
+                         self._assigned)
+
+    # in-place version of eliminate; returns self
+    def eliminateInPlace(self, vs):
+        axes, vs, domains = self._split(vs)
+        if len(axes) > 0:
+            self._factor  = np.asarray(logsumexp(self._factor, axis=axes))
+            self._vars    = vs
+            self._domains = domains
+            self._shared  = False
+        return self
 
     # return a marginalized log factor (NOT PROBABILITY) over specific vars
     # this is similar to eliminate but takes the variable you want to keep
     # instead of those you want to eliminate
     def marginal(self, vs):
-        newFactor = self._copy()
         for v in vs:
-            newFactor._assertVarExists(v)
-        allVars = set(newFactor._vars)
-        toEliminate = allVars - set(vs)
-        return newFactor.eliminate(toEliminate)
+            self._assertVarExists(v)
+        return self.eliminate(set(self._vars) - set(vs))
 
     # exponentiate and then normalize this factor to return probabilities
     def toProbs(self):
-        newFactor = self._copy()
-        newFactor._factor = np.exp(newFactor._factor - newFactor.logZ())
-        return newFactor # NO LONGER IN LOG SPACE!
+        return self._new(self._vars, self._domains,
+                         np.exp(self._factor - self._perBatch(self.logZ())),
+                         self._assigned) # NO LONGER IN LOG SPACE!
+
+    # normalize this factor in place so that it sums to 1 (it STAYS in log
+    # space); returns self
+    def normalizeInPlace(self):
+        self._writable()
+        self._factor -= self._perBatch(self.logZ())
+        return self
 
     # calcualte the log of the partition function
     def logZ(self):
-        #toReturn = self._copy()._factor
-        #for dim in range(self._factor.ndim):
-        #    toReturn = logsumexp(toReturn, 0)
-        #return toReturn
         return logsumexp(self._factor)
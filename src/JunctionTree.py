@@ -0,0 +1,180 @@
+import numpy as np
+from   Factor import Factor
+
+# cost of eliminating var next from the (undirected) interaction graph
+# nbrs (a dictionary mapping each variable to the set of its neighbours):
+#   minfill   - the number of fill-in edges eliminating var would add
+#   minweight - the number of entries in the clique eliminating var creates
+def _eliminationCost(var, nbrs, domains, heuristic):
+    if heuristic == 'minfill':
+        ns = list(nbrs[var])
+        return sum([ 1 for i, a in enumerate(ns) for b in ns[i+1:]
+                     if b not in nbrs[a] ])
+    elif heuristic == 'minweight':
+        return np.prod([ domains[v] for v in nbrs[var] ] + [ domains[var] ])
+    assert False, "Unknown heuristic: " + str(heuristic)
+
+# greedily pick an order in which to eliminate the variables in toEliminate
+# (all variables by default) from the graph in which the variables of each
+# scope are connected.  domains maps each variable to its domain.  Returns
+# the order and, for each eliminated variable, the clique (a frozenset of
+# variables) its elimination creates
+def eliminationOrder(scopes, domains, heuristic='minfill', toEliminate=None):
+    nbrs = dict([ (v, set()) for v in domains ])
+    for scope in scopes:
+        for v in scope:
+            nbrs[v].update([ u for u in scope if u != v ])
+
+    if toEliminate is None:
+        toEliminate = list(domains.keys())
+    remaining = set(toEliminate)
+    order, cliques = [], []
+    while remaining:
+        var = min(remaining, key=lambda v: (
+            _eliminationCost(v, nbrs, domains, heuristic), str(v)))
+        ns  = nbrs.pop(var)
+        for a in ns:
+            nbrs[a].discard(var)
+            nbrs[a].update([ b for b in ns if b != a ])
+        remaining.remove(var)
+        order.append(var)
+        cliques.append(frozenset(ns) | frozenset([var]))
+    return order, cliques
+
+class JunctionTree:
+    """
+    Compiles any list of log Factors into a junction tree: picks an
+    elimination order with the min-fill or min-weight heuristic, keeps the
+    maximal cliques it creates and connects them with a maximum spanning
+    tree over sepset sizes.  Compiling does not allocate any clique tables,
+    so maxCliqueSize() can be checked before calling calibrate()
+    """
+
+    def __init__(self, factors, heuristic='minfill'):
+        self._factors = factors
+        self._domains = {}
+        for f in factors:
+            for v, d in zip(f._vars, f._domains):
+                assert self._domains.get(v, d) == d, (
+                    "Domain mismatch for var: " + str(v))
+                self._domains[v] = d
+
+        scopes = [ f._vars for f in factors ]
+        self._order, created = eliminationOrder(scopes, self._domains,
+                                                heuristic)
+
+        # keep only the maximal cliques
+        self._cliques = []
+        for c in sorted(set(created), key=len, reverse=True):
+            if not any([ c <= kept for kept in self._cliques ]):
+                self._cliques.append(c)
+        self._cliques = [ tuple(v for v in self._order if v in c)
+                          for c in self._cliques ]
+
+        self._buildTree()
+
+        # each factor goes to the smallest clique that covers its scope
+        self._assigned = [ [] for c in self._cliques ]
+        for f in factors:
+            fits = [ i for i, c in enumerate(self._cliques)
+                     if set(f._vars) <= set(c) ]
+            best = min(fits, key=lambda i: len(self._cliques[i]))
+            self._assigned[best].append(f)
+
+        self._potentials = None
+        self._messages   = None
+
+    # Kruskal's algorithm over sepset sizes; builds the neighbour lists
+    def _buildTree(self):
+        n      = len(self._cliques)
+        parent = list(range(n))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        edges = [ (len(set(self._cliques[i]) & set(self._cliques[j])), i, j)
+                  for i in range(n) for j in range(i + 1, n) ]
+        self._nbrs = [ [] for c in self._cliques ]
+        for (size, i, j) in sorted(edges, key=lambda e: -e[0]):
+            if size > 0 and find(i) != find(j):
+                parent[find(i)] = find(j)
+                self._nbrs[i].append(j)
+                self._nbrs[j].append(i)
+
+    def eliminationOrdering(self):
+        return self._order
+
+    def getCliques(self):
+        return self._cliques
+
+    # number of entries in the biggest clique table calibrate() will build
+    def maxCliqueSize(self):
+        return max([ np.prod([ self._domains[v] for v in c ])
+                     for c in self._cliques ])
+
+    # (clique, parent) pairs of every tree in the forest, roots first
+    def _traversal(self):
+        seen, order = set(), []
+        for root in range(len(self._cliques)):
+            if root in seen:
+                continue
+            stack = [ (root, None) ]
+            while stack:
+                i, p = stack.pop()
+                seen.add(i)
+                order.append((i, p))
+                stack.extend([ (j, i) for j in self._nbrs[i] if j != p ])
+        return order
+
+    def _message(self, i, j):
+        incoming = [ self._messages[(k, i)] for k in self._nbrs[i] if k != j ]
+        clique   = Factor.product([ self._potentials[i] ] + incoming)
+        return clique.eliminate(set(self._cliques[i]) -
+                                set(self._cliques[j]))
+
+    # build the clique potentials and run two-pass message passing (leaves
+    # to root, then root to leaves).  If maxEntries is given, refuse to
+    # allocate a clique table bigger than that
+    def calibrate(self, maxEntries=None):
+        if maxEntries is not None:
+            assert self.maxCliqueSize() <= maxEntries, (
+                "Biggest clique has " + str(self.maxCliqueSize()) +
+                " entries, more than the allowed " + str(maxEntries))
+
+        self._potentials = []
+        for c, fs in zip(self._cliques, self._assigned):
+            domains = [ self._domains[v] for v in c ]
+            self._potentials.append(
+                Factor.product([ Factor(c, domains, np.zeros(domains)) ] + fs))
+
+        self._messages = {}
+        traversal = self._traversal()
+        for i, p in reversed(traversal):
+            if p is not None:
+                self._messages[(i, p)] = self._message(i, p)
+        for i, p in traversal:
+            if p is not None:
+                self._messages[(p, i)] = self._message(p, i)
+
+    # calibrated belief of the i-th clique
+    def belief(self, i):
+        assert self._messages is not None, "Call calibrate() first!"
+        incoming = [ self._messages[(k, i)] for k in self._nbrs[i] ]
+        return Factor.product([ self._potentials[i] ] + incoming)
+
+    # returns the marginal probabilities of a single variable
+    def marginal(self, var):
+        i = min([ i for i, c in enumerate(self._cliques) if var in c ],
+                key=lambda i: len(self._cliques[i]))
+        return self.belief(i).marginal([var]).toProbs()
+
+    # returns marginals over all variables as a dictionary
+    def allMarginals(self):
+        return dict([ (v, self.marginal(v)) for v in self._order ])
+
+    # log of the partition function (summed over the trees of the forest)
+    def logZ(self):
+        return sum([ self.belief(i).logZ()
+                     for i, p in self._traversal() if p is None ])
@@ -0,0 +1,85 @@
+import numpy as np
+from   scipy.special import logsumexp
+
+# Batched inference for linear-chain models (e.g. a linear-chain CRF) whose
+# potentials are plain arrays in log space:
+#   unary       - a (B x T x L) array: B sequences of length T over L labels
+#   transitions - an (L x L) array; transitions[i][j] scores label i followed
+#                 by label j
+# Every step is one numpy call across the whole batch.  Sequences of
+# different lengths are padded to T; lengths holds the true length of each.
+
+# MAP decoding of every sequence in the batch.  Returns a (B x T) array of
+# the best labels and the (unnormalized) log score of each best path.  If
+# lengths is given, decoding of each sequence stops at its true length and
+# its padding positions repeat its last label
+def viterbi(unary, transitions, lengths=None):
+    B, T, L  = unary.shape
+    if lengths is None:
+        lengths = np.full(B, T)
+    lengths  = np.asarray(lengths)[:, np.newaxis]
+    backptrs = np.empty((B, max(T - 1, 0), L), dtype=int)
+    delta    = unary[:, 0].copy()
+    for t in range(1, T):
+        scores           = delta[:, :, np.newaxis] + transitions
+        inside           = t < lengths
+        backptrs[:, t-1] = np.where(inside, scores.argmax(axis=1),
+                                    np.arange(L))
+        delta            = np.where(inside, scores.max(axis=1) + unary[:, t],
+                                    delta)
+
+    rows        = np.arange(B)
+    path        = np.empty((B, T), dtype=int)
+    path[:, -1] = delta.argmax(axis=1)
+    for t in range(T - 1, 0, -1):
+        path[:, t-1] = backptrs[rows, t-1, path[:, t]]
+    return path, delta[rows, path[:, -1]]
+
+# log-space forward-backward over a padded batch.  Returns log Z of each
+# sequence (B), the unary marginals (B x T x L) and the pairwise marginals
+# (B x T-1 x L x L; entry [b,t,i,j] is P(y_t = i, y_t+1 = j)).  Marginals
+# of padding positions are 0
+def forwardBackward(unary, transitions, lengths):
+    B, T, L = unary.shape
+    lengths = np.asarray(lengths)[:, np.newaxis]
+
+    # alpha is carried unchanged past the end of each sequence, so the last
+    # column holds every sequence's final forward message
+    alpha       = np.empty((B, T, L))
+    alpha[:, 0] = unary[:, 0]
+    for t in range(1, T):
+        step        = logsumexp(alpha[:, t-1, :, np.newaxis] + transitions,
+                                axis=1) + unary[:, t]
+        alpha[:, t] = np.where(t < lengths, step, alpha[:, t-1])
+    logZ = logsumexp(alpha[:, -1], axis=1)
+
+    # beta is 0 at (and after) the last position of each sequence
+    beta = np.zeros((B, T, L))
+    for t in range(T - 2, -1, -1):
+        step       = logsumexp(transitions + (unary[:, t+1] + beta[:, t+1])
+                               [:, np.newaxis, :], axis=2)
+        beta[:, t] = np.where(t + 1 < lengths, step, 0.0)
+
+    valid      = (np.arange(T) < lengths)[:, :, np.newaxis]
+    unaryMarg  = np.where(valid, np.exp(alpha + beta -
+                                        logZ[:, np.newaxis, np.newaxis]), 0.0)
+    pairMarg   = np.exp(alpha[:, :-1, :, np.newaxis] + transitions +
+                        (unary[:, 1:] + beta[:, 1:])[:, :, np.newaxis, :] -
+                        logZ[:, np.newaxis, np.newaxis, np.newaxis])
+    pairMarg  *= valid[:, 1:, :, np.newaxis]
+    return logZ, unaryMarg, pairMarg
+
+# split sequence indices into buckets of at most bucketSize sequences of
+# similar length (so padding wastes little)
+def lengthBuckets(lengths, bucketSize):
+    order = np.argsort(lengths, kind='mergesort')
+    return [ order[i:i + bucketSize]
+             for i in range(0, len(order), bucketSize) ]
+
+# for sequences of the given lengths stacked one on top of another, the
+# (sequence, position) of every stacked row in the padded batch
+def paddedPositions(lengths):
+    lengths = np.asarray(lengths)
+    seqs    = np.repeat(np.arange(len(lengths)), lengths)
+    starts  = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return seqs, np.arange(np.sum(lengths)) - starts
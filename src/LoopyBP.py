@@ -0,0 +1,234 @@
+import time
+import numpy as np
+from   scipy.special import logsumexp
+from   Factor        import Factor
+
+class LoopyBP:
+    """
+    Loopy belief propagation (sum-product) over a factor graph given as a
+    list of log Factors.  Factors with the same domains are stacked into one
+    tensor and all of their messages live in flat, preallocated arrays, so a
+    sweep is a handful of numpy calls per group of factors instead of a
+    Python loop over edges.  Everything stays in log space
+    """
+
+    # factors is a list of log Factors.  Options:
+    #   schedule - 'synchronous' updates every factor each sweep; 'residual'
+    #              keeps every factor's next messages pending, commits those
+    #              of the factors whose messages would change the most (the
+    #              top residualFraction of them) and then recomputes only
+    #              the factors that share a variable with a committed one
+    #   damping  - weight given to the old message, between 0 and 1
+    #   tol      - stop once no message changes by more than this
+    #   maxIters - stop after this many sweeps regardless
+    def __init__(self, factors, schedule='synchronous', damping=0.0,
+                 tol=1e-6, maxIters=100, residualFraction=0.5):
+        assert schedule in ('synchronous', 'residual'), (
+            "Unknown schedule: " + str(schedule))
+        assert 0.0 <= damping < 1.0, "Damping must be in [0, 1)"
+
+        self._schedule = schedule
+        self._damping  = damping
+        self._tol      = tol
+        self._maxIters = maxIters
+        self._fraction = residualFraction
+
+        # variables and the flat layout of their beliefs
+        self._vars, self._var2ind, domains = [], {}, []
+        for f in factors:
+            for v, d in zip(f._vars, f._domains):
+                if v not in self._var2ind:
+                    self._var2ind[v] = len(self._vars)
+                    self._vars.append(v)
+                    domains.append(d)
+                assert domains[self._var2ind[v]] == d, (
+                    "Domain mismatch for var: " + str(v))
+        self._domains   = np.array(domains, dtype=int)
+        self._varOffset = np.append(0, np.cumsum(self._domains))
+
+        # group factors by the domains of their scope and stack them
+        groups = {}
+        for f in factors:
+            if len(f._vars) > 0:
+                groups.setdefault(tuple(f._domains), []).append(f)
+
+        self._tensors, self._varInds, self._blocks = [], [], []
+        size = 0
+        for doms, fs in groups.items():
+            self._tensors.append(np.array([ f._factor for f in fs ]))
+            self._varInds.append(np.array([ [ self._var2ind[v]
+                                              for v in f._vars ]
+                                            for f in fs ], dtype=int))
+            # one (start, stop, nFactors, domain) block per position
+            blocks = []
+            for d in doms:
+                blocks.append((size, size + len(fs) * d, len(fs), d))
+                size += len(fs) * d
+            self._blocks.append(blocks)
+
+        # flat message arrays and, for every message entry, the flat index of
+        # the belief entry it contributes to
+        self._f2v = np.zeros(size)
+        self._v2f = np.zeros(size)
+        self._beliefIdx = np.empty(size, dtype=int)
+        for inds, blocks in zip(self._varInds, self._blocks):
+            for j, (start, stop, n, d) in enumerate(blocks):
+                idx = self._varOffset[inds[:, j]][:, np.newaxis] + np.arange(d)
+                self._beliefIdx[start:stop] = idx.ravel()
+        self._beliefs = np.zeros(self._varOffset[-1])
+
+        # residual schedule: the next messages of every factor, not yet
+        # committed to self._f2v
+        self._pending = None
+
+        self.iterations = 0
+        self.sweepTimes = []
+        self.residuals  = []
+        self.updates    = []
+
+    # a (nFactors x domain) view of a block of a flat message array
+    def _block(self, flat, block):
+        start, stop, n, d = block
+        return flat[start:stop].reshape(n, d)
+
+    # normalize each row of a block of log messages
+    def _normalizeRows(self, msgs):
+        norm = logsumexp(msgs, axis=1)[:, np.newaxis]
+        return np.where(np.isfinite(norm), msgs - norm, msgs)
+
+    # sum incoming factor->variable messages into the beliefs
+    def _updateBeliefs(self):
+        self._beliefs = np.bincount(self._beliefIdx, weights=self._f2v,
+                                    minlength=len(self._beliefs))
+
+    # variable->factor messages: belief minus the message from that factor
+    def _updateVarMessages(self):
+        v2f = self._beliefs[self._beliefIdx] - self._f2v
+        v2f[np.isnan(v2f)] = -np.inf
+        for blocks in self._blocks:
+            for block in blocks:
+                msgs = self._block(v2f, block)
+                msgs[...] = self._normalizeRows(msgs)
+        self._v2f = v2f
+
+    # new (damped) factor->variable messages, written into out.  rows holds
+    # the indices of the factors to update in each group (None updates all
+    # of them); returns the number of factors updated
+    def _factorMessages(self, out, rows=None):
+        nUpdated = 0
+        for g, (tensor, blocks) in enumerate(zip(self._tensors, self._blocks)):
+            sel = slice(None) if rows is None else rows[g]
+            if rows is not None:
+                if len(sel) == 0:
+                    continue
+                tensor = tensor[sel]
+            nUpdated += tensor.shape[0]
+            k = len(blocks)
+            incoming = []
+            for j, block in enumerate(blocks):
+                shape    = [ -1 ] + [ 1 ] * k
+                shape[j + 1] = block[3]
+                incoming.append(
+                    self._block(self._v2f, block)[sel].reshape(shape))
+            for j, block in enumerate(blocks):
+                acc = tensor
+                for l in range(k):
+                    if l != j:
+                        acc = acc + incoming[l]
+                axes = tuple(a + 1 for a in range(k) if a != j)
+                msgs = logsumexp(acc, axis=axes) if axes else acc
+                msgs = self._normalizeRows(msgs)
+                if self._damping > 0.0:
+                    old    = self._block(self._f2v, block)[sel]
+                    damped = (1.0 - self._damping) * msgs + self._damping * old
+                    msgs   = np.where(np.isnan(damped), msgs, damped)
+                self._block(out, block)[sel] = msgs
+        return nUpdated
+
+    # largest change of any message of each factor, one array per group
+    def _factorResiduals(self, new, old):
+        diff = np.abs(new - old)
+        diff[np.isnan(diff)] = 0.0  # both -inf: no change
+        residuals = []
+        for blocks in self._blocks:
+            residuals.append(np.max([ self._block(diff, b).max(axis=1)
+                                      for b in blocks ], axis=0))
+        return residuals
+
+    # one synchronous sweep; returns the largest message change and the
+    # number of factors updated
+    def _sweep(self):
+        self._updateVarMessages()
+        new       = np.empty_like(self._f2v)
+        nUpdated  = self._factorMessages(new)
+        residuals = self._factorResiduals(new, self._f2v)
+        self._f2v = new
+        self._updateBeliefs()
+        return max([ r.max() for r in residuals ] + [ 0.0 ]), nUpdated
+
+    # one residual sweep: commit the pending messages of the factors with
+    # the largest residuals, then recompute the pending messages of just the
+    # factors whose incoming messages changed (those sharing a variable
+    # with a committed factor).  Returns the largest pending change and the
+    # number of factors updated
+    def _residualSweep(self):
+        nUpdated = 0
+        if self._pending is None:
+            self._updateVarMessages()
+            self._pending = np.empty_like(self._f2v)
+            nUpdated += self._factorMessages(self._pending)
+
+        residuals = self._factorResiduals(self._pending, self._f2v)
+        cutoff    = np.percentile(np.concatenate(residuals),
+                                  100.0 * (1.0 - self._fraction))
+        changed   = np.zeros(len(self._vars), dtype=bool)
+        for res, inds, blocks in zip(residuals, self._varInds, self._blocks):
+            commit = res >= cutoff
+            for b in blocks:
+                self._block(self._f2v, b)[commit] = (
+                    self._block(self._pending, b)[commit])
+            changed[inds[commit]] = True
+        self._updateBeliefs()
+        self._updateVarMessages()
+
+        rows      = [ np.nonzero(np.any(changed[inds], axis=1))[0]
+                      for inds in self._varInds ]
+        nUpdated += self._factorMessages(self._pending, rows)
+        residuals = self._factorResiduals(self._pending, self._f2v)
+        return max([ r.max() for r in residuals ] + [ 0.0 ]), nUpdated
+
+    # run BP until convergence or maxIters sweeps; returns True if converged
+    def run(self):
+        self._updateBeliefs()
+        for it in range(self._maxIters):
+            start = time.time()
+            if self._schedule == 'residual':
+                residual, nUpdated = self._residualSweep()
+            else:
+                residual, nUpdated = self._sweep()
+            self.sweepTimes.append(time.time() - start)
+            self.residuals.append(residual)
+            self.updates.append(nUpdated)
+            self.iterations += 1
+            if residual < self._tol:
+                return True
+        return False
+
+    # summary of the last run: iterations, time per sweep, residuals and
+    # the number of factors whose messages each sweep computed
+    def stats(self):
+        return { 'iterations'   : self.iterations,
+                 'timePerSweep' : np.mean(self.sweepTimes)
+                                  if self.sweepTimes else 0.0,
+                 'residuals'    : list(self.residuals),
+                 'updates'      : list(self.updates) }
+
+    # returns the (approximate) marginal probabilities of a single variable
+    def marginal(self, var):
+        i      = self._var2ind[var]
+        belief = self._beliefs[self._varOffset[i]:self._varOffset[i + 1]]
+        return Factor([ var ], [ self._domains[i] ], belief).toProbs()
+
+    # returns marginals over all variables as a dictionary
+    def allMarginals(self):
+        return dict([ (v, self.marginal(v)) for v in self._vars ])
@@ -0,0 +1,220 @@
+import numpy as np
+from   scipy.special import logsumexp
+from   Factor        import Factor
+
+class SparseFactor(object):
+    """
+    Represents a log factor that is mostly -inf (i.e. mostly zero
+    probability) as a table of the entries that are NOT -inf: one row of
+    coordinates and one value per entry.  Memory and time scale with the
+    number of such entries rather than with the product of the domains
+    """
+    __slots__ = ('_vars', '_domains', '_coords', '_values', '_assigned')
+
+    # factors whose fraction of non -inf entries is above this are stored
+    # densely (see compact)
+    DENSITY_THRESHOLD = 0.25
+
+    def _assertVarExists(self, v):
+        assert v in self._vars, "Factor doesn't touch " + str(v)
+
+    def _assertValWithinDomain(self, var, val):
+        self._assertVarExists(var)
+        assert self._domains[self._vars.index(var)] > val, (
+            str(val) + " is outside the valid domain of var: " + str(var))
+
+    # coords is an (nnz x len(variables)) integer array whose columns are in
+    # the same order as variables; values are the matching log values.  Each
+    # setting may appear at most once
+    def __init__(self, variables, domains, coords, values):
+        assert len(set(variables)) == len(variables), "Duplicate variables!"
+        assert len(variables) == len(domains), (
+            "Number of variables and number of domain entries do not match!")
+        self._vars     = tuple(variables)
+        self._domains  = np.array(domains, dtype=int)
+        self._coords   = np.reshape(np.asarray(coords, dtype=int),
+                                    (-1, len(variables)))
+        self._values   = np.asarray(values, dtype=float)
+        self._assigned = ()
+        assert self._coords.shape[0] == self._values.shape[0], (
+            "Number of coordinates and number of values do not match!")
+        assert np.all(self._coords < self._domains), (
+            "Coordinates outside the domains!")
+
+    @classmethod
+    def _new(cls, variables, domains, coords, values, assigned=()):
+        newFactor = object.__new__(cls)
+        newFactor._vars     = variables
+        newFactor._domains  = domains
+        newFactor._coords   = coords
+        newFactor._values   = values
+        newFactor._assigned = assigned
+        return newFactor
+
+    # build a sparse factor from the non -inf entries of a dense one
+    @staticmethod
+    def fromDense(factor):
+        assert factor._NBATCH == 0, "Batched factors can't be made sparse!"
+        mask = factor._factor != -np.inf
+        return SparseFactor._new(factor._vars, factor._domains,
+                                 np.argwhere(mask), factor._factor[mask],
+                                 factor._assigned)
+
+    # return the equivalent dense Factor
+    def toDense(self):
+        dense = np.full(tuple(self._domains), -np.inf)
+        if len(self._vars) == 0:
+            dense[()] = self.logZ()
+        else:
+            dense[tuple(self._coords.T)] = self._values
+        return Factor._new(self._vars, self._domains, dense, self._assigned)
+
+    # fraction of entries that are not -inf
+    def density(self):
+        return len(self._values) / float(np.prod(self._domains))
+
+    # return factor in whichever representation suits its density
+    @staticmethod
+    def compact(factor, threshold=None):
+        if threshold is None:
+            threshold = SparseFactor.DENSITY_THRESHOLD
+        if isinstance(factor, SparseFactor):
+            return factor.toDense() if factor.density() > threshold else factor
+        if factor._NBATCH > 0:
+            return factor
+        density = (np.count_nonzero(factor._factor != -np.inf) /
+                   float(factor._factor.size))
+        if density > threshold:
+            return factor
+        return SparseFactor.fromDense(factor)
+
+    # flat (ravelled) index of every row of coords over the given domains
+    @staticmethod
+    def _keys(coords, domains):
+        if len(domains) == 0:
+            return np.zeros(coords.shape[0], dtype=int)
+        return np.ravel_multi_index(tuple(coords.T), tuple(domains))
+
+    # get current ordering of the variables
+    def varOrdering(self):
+        return self._vars
+
+    # assignment is a dictionary that maps variables to indicies
+    # the dictionary MUST have an entry for each variable!
+    def get(self, assignment):
+        assert set(assignment.keys()) == set(self._vars), (
+            "Assignment/Joint variables must match!")
+        for var, val in assignment.items():
+            self._assertValWithinDomain(var, val)
+
+        setting = np.array([ assignment[v] for v in self._vars ], dtype=int)
+        rows    = np.nonzero(np.all(self._coords == setting, axis=1))[0]
+        return self._values[rows[0]] if len(rows) > 0 else -np.inf
+
+    # visual representation
+    def show(self):
+        assigned = []
+        for var, assignment in self._assigned:
+            assigned.append(str(var) + " = " + str(assignment))
+        return ("S(" + ",".join([str(v) for v in self._vars] + assigned) +
+                ")")
+
+    # log-factor add (factor multiply).  Only settings that are non -inf in
+    # BOTH factors survive, so the work is a join on the shared variables:
+    # rows of the other factor are sorted by their shared-variable key and
+    # each of our rows is matched to its run of partners with searchsorted
+    def add(self, newFactor):
+        if not isinstance(newFactor, SparseFactor):
+            if set(newFactor._vars).issubset(self._vars):
+                return self._addDenseSubset(newFactor)
+            newFactor = SparseFactor.fromDense(newFactor)
+
+        shared  = [ v for v in self._vars if v in newFactor._vars ]
+        newVars = [ v for v in newFactor._vars if v not in self._vars ]
+        myCols  = [ self._vars.index(v) for v in shared ]
+        nwCols  = [ newFactor._vars.index(v) for v in shared ]
+        sharedD = [ self._domains[i] for i in myCols ]
+        for i, j in zip(myCols, nwCols):
+            assert self._domains[i] == newFactor._domains[j], (
+                "Domain mismatch for var: " + str(self._vars[i]))
+
+        myKeys = self._keys(self._coords[:, myCols], sharedD)
+        nwKeys = self._keys(newFactor._coords[:, nwCols], sharedD)
+        order  = np.argsort(nwKeys, kind='mergesort')
+        nwKeys = nwKeys[order]
+        lo     = np.searchsorted(nwKeys, myKeys, 'left')
+        counts = np.searchsorted(nwKeys, myKeys, 'right') - lo
+
+        myRows = np.repeat(np.arange(len(myKeys)), counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        nwRows = order[lo[myRows] + np.arange(len(myRows)) - starts]
+
+        newCols = [ newFactor._vars.index(v) for v in newVars ]
+        coords  = np.hstack((self._coords[myRows],
+                             newFactor._coords[nwRows][:, newCols]))
+        values  = self._values[myRows] + newFactor._values[nwRows]
+        domains = np.concatenate((self._domains,
+                                  newFactor._domains[newCols]))
+        return SparseFactor.compact(
+            SparseFactor._new(self._vars + tuple(newVars), domains,
+                              coords, values))
+
+    # add a dense factor whose variables are all ours: just look up its
+    # value for each of our rows
+    def _addDenseSubset(self, factor):
+        cols   = [ self._vars.index(v) for v in factor._vars ]
+        values = self._values + factor._factor[tuple(self._coords[:, cols].T)]
+        keep   = values != -np.inf
+        return SparseFactor._new(self._vars, self._domains,
+                                 self._coords[keep], values[keep],
+                                 self._assigned)
+
+    # observe a single variable; keeps only the rows that agree with it
+    def observe(self, var, val):
+        self._assertValWithinDomain(var, val)
+        dim  = self._vars.index(var)
+        rows = self._coords[:, dim] == val
+        return SparseFactor.compact(
+            SparseFactor._new(self._vars[:dim] + self._vars[dim + 1:],
+                              np.delete(self._domains, dim),
+                              np.delete(self._coords[rows], dim, axis=1),
+                              self._values[rows],
+                              self._assigned + ((var, val),)))
+
+    # variable elimination; rows that agree on the remaining variables are
+    # grouped together and each group is reduced with a logsumexp
+    def eliminate(self, vs):
+        vs   = set(vs)
+        keep = [ i for i,v in enumerate(self._vars) if v not in vs ]
+        if len(keep) == len(self._vars):
+            return self
+
+        domains = self._domains[keep]
+        keys    = self._keys(self._coords[:, keep], domains)
+        uniq, first, group = np.unique(keys, return_index=True,
+                                       return_inverse=True)
+        group  = np.reshape(group, -1)
+        maxes  = np.full(len(uniq), -np.inf)
+        np.maximum.at(maxes, group, self._values)
+        sums   = np.zeros(len(uniq))
+        np.add.at(sums, group, np.exp(self._values - maxes[group]))
+        return SparseFactor.compact(
+            SparseFactor._new(tuple(self._vars[i] for i in keep), domains,
+                              self._coords[first][:, keep],
+                              maxes + np.log(sums), self._assigned))
+
+    # return a marginalized log factor (NOT PROBABILITY) over specific vars
+    def marginal(self, vs):
+        for v in vs:
+            self._assertVarExists(v)
+        return self.eliminate(set(self._vars) - set(vs))
+
+    # exponentiate and then normalize this factor to return probabilities
+    def toProbs(self):
+        return self.toDense().toProbs() # NO LONGER IN LOG SPACE!
+
+    # calcualte the log of the partition function
+    def logZ(self):
+        if len(self._values) == 0:
+            return -np.inf
+        return logsumexp(self._values)
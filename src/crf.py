@@ -1,15 +1,62 @@
 from   scipy       import optimize as opt
-from   factor      import Factor
-from   cliqueChain import CliqueChain
+from   scipy       import sparse
+from   multiprocessing import Pool
+from   Factor      import Factor
+from   CliqueChain import CliqueChain
+from   LinearChain import viterbi, forwardBackward
+from   LinearChain import lengthBuckets, paddedPositions
 import numpy  as     np
 
-from config import CHARS, CHARS_DICT
+# yields (instances, labels) mini-batches of at most batchSize sequences,
+# in a new random order each time it is called if shuffle is set
+def miniBatches(instances, labels, batchSize, shuffle=True):
+    order = np.arange(len(instances))
+    if shuffle:
+        np.random.shuffle(order)
+    for start in range(0, len(order), batchSize):
+        inds = order[start:start + batchSize]
+        yield [ instances[i] for i in inds ], [ labels[i] for i in inds ]
+
+# yields one (instances, labels) mini-batch per .npz file in paths, so a
+# corpus can be streamed from disk one file at a time.  Each file holds
+#   feats   - the feature rows of its sequences stacked on top of each other
+#   labels  - the label index of every row
+#   lengths - the length of each sequence
+def npzMiniBatches(paths):
+    for path in paths:
+        data   = np.load(path)
+        splits = np.cumsum(data['lengths'])[:-1]
+        yield (np.split(data['feats'], splits),
+               np.split(data['labels'], splits))
+
+# state of a parallel training worker process: a CRF holding its own shard
+# of the length buckets of the training set (and nothing else).  Set once
+# when the worker starts so each step only has to ship the current params
+_worker = {}
+
+def _initWorker(numLabels, numFeats, shard):
+    crf = CRF(np.zeros((numLabels, numFeats)),
+              np.zeros((numLabels, numLabels)), None, None)
+    crf._batches   = shard
+    _worker['crf'] = crf
+
+# log likelihood and gradients of each bucket of the worker's shard
+def _shardValueAndGrad(weightsAndTransProbs):
+    crf = _worker['crf']
+    weights, transProbs = crf._unpack(weightsAndTransProbs)
+    return crf._evaluate(crf._trainingBatches(), weights, transProbs)
 
 class CRF:
     """
     Implements a CRF -- more later
     """
 
+    # training sequences are processed in length buckets of this many
+    _BUCKET_SIZE = 256
+
+    # number of (params, value, gradient) evaluations remembered
+    _MEMO_SIZE = 2
+
     # This is a discrete state CRF...fill this out
     # Weights is an NxM numpy array:
     #   N - number of different possible labels
@@ -29,17 +76,45 @@ class CRF:
         self._ws        = weights
         self._tps       = transProbs
         self._VAR_PREF  = 'label'
+        self._batches   = None
+        self._memo      = []
+        self._callback  = None
+        self._pools     = None
+        self._history   = []
 
     def _label(self, i):
         assert type(i) is int
         return self._VAR_PREF + str(i)
 
-    # turn an instance into a cliqueChain
-    def _instance2Chain(self, instance, weights, transProbs):
+    # an instance as a (T x M) feature matrix.  Instances can be dense
+    # numpy arrays, scipy.sparse matrices or, for binary features, a list
+    # holding the indices of the active features at each position; the
+    # latter two become CSR matrices so work scales with the active features
+    def _featureMatrix(self, instance):
+        if sparse.issparse(instance):
+            instance = sparse.csr_matrix(instance)
+        elif not isinstance(instance, np.ndarray):
+            indptr   = np.cumsum([ 0 ] + [ len(a) for a in instance ])
+            indices  = np.concatenate([ np.asarray(a, dtype=int)
+                                        for a in instance ] +
+                                      [ np.zeros(0, dtype=int) ])
+            shape    = (len(instance), self._numFeats)
+            instance = sparse.csr_matrix((np.ones(len(indices)), indices,
+                                          indptr), shape=shape)
         assert instance.shape[1] == self._numFeats, (
-            "Instance passed in must have " + self._numFeats + " features!")
+            "Instance passed in must have " + str(self._numFeats) +
+            " features!")
+        return instance
 
-        potentials = np.dot(weights, np.transpose(instance))
+    # label potentials (T x N) of an instance; only touches the active
+    # features of sparse instances
+    def _potentials(self, instance, weights):
+        return self._featureMatrix(instance).dot(np.transpose(weights))
+
+    # turn an instance into a cliqueChain
+    def _instance2Chain(self, instance, weights, transProbs):
+        instance   = self._featureMatrix(instance)
+        potentials = np.transpose(self._potentials(instance, weights))
         labelFctrs = [ Factor([self._label(i)],
                               [ self._numLabels ],
                               potentials[:,i])
@@ -63,112 +138,212 @@ class CRF:
 
     # get the average log likelihood for a group of instances and assignments
     def avgLogLikelihood(self, instances, labels, weights, transProbs):
-        return sum([ self.instanceLogLikelihood(i,a,weights,transProbs)
-                     for i,a in zip(instances, labels)
-                     ]) / float(len(instances))
-
-    # NEEDS BETTER DOCUMENTATION!!!!
-    # derivative of the object function (log likelihood) with respect to the
-    # feature weights (produces a NxM vector)
-    def _labelWeightsDerivHelper(self, inst, marginals, varNames, labels):
-        actualMinusExpectedCounts = np.zeros((self._numLabels, self._numFeats))
-
-        for i,var in enumerate(varNames):
-            counts = np.zeros(self._numLabels)
-            counts[labels[var]] += 1.0
-            counts -= marginals[var]._factor
-
-            actualMinusExpectedCounts += (counts[:,np.newaxis] * inst[i])
-
-        return actualMinusExpectedCounts
-
-    # MUST DOCUMENT BETTER!
-    # derivative of the object function (log likelihood) with respect to the
-    # transition probabilities (produces an MxM vector)
-    def _transProbsDerivHelper(self, pairMarg, varNames, labels):
-        actualMinusExpectedCounts = np.zeros((self._numLabels,self._numLabels))
-
-        # commence numpy voodoo
-        transitions = [ (labels[v1], labels[v2])
-                        for (v1,v2) in zip(varNames, varNames[1:]) ]
-
-        relevantMargs = np.array([ pairMarg[v]._factor[t1][t2]
-                                   for (v, (t1,t2))
-                                   in zip(varNames, transitions) ])
-
-        for i,v in enumerate(varNames[:-1]):
-            (v1,v2) = transitions[i]
-            actualMinusExpectedCounts[v1][v2] += 1.0
-            actualMinusExpectedCounts -= pairMarg[v]._factor
-
-        return actualMinusExpectedCounts
-
-    # jacobian of the objective; this returns a long vector of all params
-    def _jacobian(self, weightsAndTransProbs):
+        batches = self._packBatches(instances, labels)
+        return (self._sumResults(self._evaluate(batches, weights,
+                                                transProbs))[0] /
+                float(len(instances)))
+
+    # labels of one sequence (a label dictionary as passed to train, or an
+    # array of label indices) as an array of label indices
+    def _labelArray(self, labels, length):
+        if not isinstance(labels, dict):
+            return np.asarray(labels, dtype=int)
+        return np.array([ labels[self._label(i)] for i in range(length) ],
+                        dtype=int)
+
+    # split the weights-and-transition vector scipy optimizes over
+    def _unpack(self, weightsAndTransProbs):
         nL, nF = self._numLabels, self._numFeats
         weights    = np.reshape(weightsAndTransProbs[:(nL * nF)], (nL, nF))
         transProbs = np.reshape(weightsAndTransProbs[(nL * nF):], (nL, nL))
+        return weights, transProbs
+
+    # pack instances into length buckets.  Each bucket holds the feature
+    # rows of its sequences stacked on top of each other, the label of every
+    # row, the (sequence, position) of every row in the padded batch, the
+    # sequence lengths and the rows that are followed by another row of the
+    # same sequence
+    def _packBatches(self, instances, labels):
+        instances = [ self._featureMatrix(inst) for inst in instances ]
+        lengths   = [ inst.shape[0] for inst in instances ]
+        batches   = []
+        for bucket in lengthBuckets(lengths, self._BUCKET_SIZE):
+            lens       = np.array([ lengths[i] for i in bucket ])
+            seqs, pos  = paddedPositions(lens)
+            hasNext    = np.ones(np.sum(lens), dtype=bool)
+            hasNext[np.cumsum(lens) - 1] = False
+            batches.append({
+                'feats'   : self._stack([ instances[i] for i in bucket ]),
+                'labels'  : np.concatenate([
+                    self._labelArray(labels[i], lengths[i])
+                    for i in bucket ]),
+                'seqs'    : seqs,
+                'pos'     : pos,
+                'lengths' : lens,
+                'prev'    : np.nonzero(hasNext)[0] })
+        return batches
+
+    # stack feature matrices on top of each other (sparse if any of them is)
+    def _stack(self, matrices):
+        if any([ sparse.issparse(m) for m in matrices ]):
+            return sparse.vstack(matrices, format='csr')
+        return np.vstack(matrices)
+
+    # the training instances packed into length buckets (done once)
+    def _trainingBatches(self):
+        if self._batches is None:
+            self._batches = self._packBatches(self._instances, self._labels)
+        return self._batches
+
+    # log-likelihood of a bucket of sequences and its gradient with respect
+    # to the label weights (NxM) and the transition parameters (NxN).  The
+    # gradients are actual minus expected counts; the expectations come
+    # from one batched forward-backward pass
+    def _batchValueAndGrad(self, batch, weights, transProbs):
+        feats, y   = batch['feats'], batch['labels']
+        rows, prev = np.arange(len(y)), batch['prev']
+
+        potentials = feats.dot(np.transpose(weights))
+        unary      = np.zeros((len(batch['lengths']),
+                               np.max(batch['lengths']), self._numLabels))
+        unary[batch['seqs'], batch['pos']] = potentials
+        logZ, unaryMarg, pairMarg = forwardBackward(unary, transProbs,
+                                                    batch['lengths'])
+
+        logLikelihood = (np.sum(potentials[rows, y]) +
+                         np.sum(transProbs[y[prev], y[prev + 1]]) -
+                         np.sum(logZ))
+
+        counts = -unaryMarg[batch['seqs'], batch['pos']]
+        counts[rows, y] += 1.0
+        weightsGrad = np.transpose(feats.T.dot(counts))
+
+        transGrad = -np.sum(pairMarg, axis=(0, 1))
+        np.add.at(transGrad, (y[prev], y[prev + 1]), 1.0)
+        return logLikelihood, weightsGrad, transGrad
+
+    # log likelihood and gradients of every bucket in batches
+    def _evaluate(self, batches, weights, transProbs):
+        return [ self._batchValueAndGrad(batch, weights, transProbs)
+                 for batch in batches ]
+
+    # total log likelihood and gradient (as one long vector of all params)
+    # of a list of per-bucket results.  Always reduced in bucket order so
+    # the result doesn't depend on how the buckets were computed
+    def _sumResults(self, results):
+        logLikelihood = 0.0
+        weightsGrad   = np.zeros((self._numLabels, self._numFeats))
+        transGrad     = np.zeros((self._numLabels, self._numLabels))
+        for (ll, wg, tg) in results:
+            logLikelihood += ll
+            weightsGrad   += wg
+            transGrad     += tg
+        return logLikelihood, np.concatenate((np.ravel(weightsGrad),
+                                              np.ravel(transGrad)))
+
+    # average log-likelihood of the training set and its gradient (as one
+    # long vector of all params), summed over the length buckets
+    def _valueAndGrad(self, weightsAndTransProbs):
+        weights, transProbs = self._unpack(weightsAndTransProbs)
+
+        if self._pools is None:
+            results = self._evaluate(self._trainingBatches(), weights,
+                                     transProbs)
+        else:
+            pending = [ pool.apply_async(_shardValueAndGrad,
+                                         (weightsAndTransProbs,))
+                        for pool in self._pools ]
+            results = [ r for p in pending for r in p.get() ]
+
+        logLikelihood, grad = self._sumResults(results)
+        n = float(len(self._instances))
+        return logLikelihood / n, grad / n
+
+    # objective (negative average log likelihood) and its gradient from a
+    # single inference pass.  The last few evaluations are memoized on the
+    # parameter vector so asking for the value and then the gradient at the
+    # same point only runs inference once.  Each new evaluation is reported
+    # to the training callback, if there is one
+    def _objectiveAndJacobian(self, weightsAndTransProbs):
+        for (x, value, grad) in self._memo:
+            if np.array_equal(x, weightsAndTransProbs):
+                return value, grad
+
+        logLikelihood, grad = self._valueAndGrad(weightsAndTransProbs)
+        value, grad = -logLikelihood, -grad
+        self._memo  = ([ (np.copy(weightsAndTransProbs), value, grad) ] +
+                       self._memo)[:self._MEMO_SIZE]
+        if self._callback is not None:
+            self._callback(value)
+        return value, grad
 
-        updatedWeights = np.zeros((self._numLabels, self._numFeats))
-        updatedTransP  = np.zeros((self._numLabels, self._numLabels))
-
-        for inst, labels in zip(self._instances, self._labels):
-            varNames = [ self._label(i) for i in range(len(inst)) ]
-            chain    = self._instance2Chain(inst, weights, transProbs)
-
-            # Pairwise marginals - the min trick picks label0 over label1, etc.
-            beliefs  = chain.sumProduct()
-            pairMarg = dict(map(lambda x: (min(x._vars), x.toProbs()),
-                                beliefs))
-
-
-            # Singleton marginals - find a way to simplify
-            vars2beliefs = {}
-            for b in beliefs:
-                for v in b._vars:
-                    vars2beliefs[v] = b
-            marginals = dict([ (var, b.marginal([var]).toProbs())
-                               for (var,b) in vars2beliefs.items() ])
-
-            updatedWeights += self._labelWeightsDerivHelper(inst,
-                                                            marginals,
-                                                            varNames,
-                                                            labels)
-            updatedTransP  += self._transProbsDerivHelper(pairMarg,
-                                                          varNames,
-                                                          labels)
-
-        return -np.concatenate((np.reshape(updatedWeights, nL * nF),
-                                np.reshape(updatedTransP, nL * nL)),
-                               axis=0) / float(len(self._instances))
+    # jacobian of the objective; this returns a long vector of all params
+    def _jacobian(self, weightsAndTransProbs):
+        return self._objectiveAndJacobian(weightsAndTransProbs)[1]
 
     # combines arguments of objective function for easy optimizing with scipy
     def _objective(self, weightsAndTransProbs):
-        J = weightsAndTransProbs.copy()
-        nL, nF     = self._numLabels, self._numFeats
-        weights    = np.reshape(J[:(nL * nF)], (nL, nF))
-        transProbs = np.reshape(J[(nL * nF):], (nL, nL))
-
         # want to maximize the log likelihood/minimize negative log likelihood
-        toReturn = -self.avgLogLikelihood(self._instances,
-                                          self._labels,
-                                          weights,
-                                          transProbs)
-        print(toReturn)
-        return toReturn
-
-    # train this CRF on the instances passed in
-    def train(self, instances, labels):
+        return self._objectiveAndJacobian(weightsAndTransProbs)[0]
+
+    # partition the length buckets once into nWorkers contiguous shards and
+    # start one single-process pool per shard, so every worker is sent (and
+    # holds) only its own shard for the rest of training
+    def _startPool(self, nWorkers):
+        batches     = self._trainingBatches()
+        shards      = [ shard for shard in
+                        np.array_split(np.arange(len(batches)), nWorkers)
+                        if len(shard) > 0 ]
+        self._pools = [ Pool(1, _initWorker,
+                             (self._numLabels, self._numFeats,
+                              [ batches[i] for i in shard ]))
+                        for shard in shards ]
+
+    def _stopPool(self):
+        for pool in self._pools or []:
+            pool.close()
+            pool.join()
+        self._pools = None
+
+    # train this CRF on the instances passed in.  If callback is given it is
+    # called with the objective value every time it is evaluated at a new
+    # point.  If nWorkers > 1 the objective and gradient are computed by a
+    # pool of that many processes (the result is the same for any number).
+    # method is passed to scipy; use "L-BFGS-B" when there are too many
+    # parameters for BFGS's dense Hessian approximation.  If heldOut (an
+    # (instances, labels) pair) is given, its average log likelihood is
+    # recorded every evalEvery iterations and after the last one (see
+    # heldOutHistory)
+    def train(self, instances, labels, callback=None, nWorkers=None,
+              method="BFGS", heldOut=None, evalEvery=1):
         self._instances = instances
         self._labels    = labels
+        self._batches   = None
+        self._memo      = []
+        self._callback  = callback
+        self._history   = []
         nL, nF = self._numLabels, self._numFeats
 
-        objective = lambda x: self._objective(x)
-        jacobian  = lambda x: self._jacobian(x)
-        result    = opt.minimize(objective,
-                                 np.random.normal(0,1,nL * nF + nL * nL),
-                                 jac=jacobian,
-                                 method="BFGS")
+        heldOut = self._packHeldOut(heldOut)
+        steps   = [ 0 ]
+        def iteration(x):
+            steps[0] += 1
+            if heldOut is not None and steps[0] % evalEvery == 0:
+                self._recordHeldOut(steps[0], x, heldOut)
+
+        if nWorkers is not None and nWorkers > 1:
+            self._startPool(nWorkers)
+        try:
+            objective = lambda x: self._objectiveAndJacobian(x)
+            result    = opt.minimize(objective,
+                                     np.random.normal(0,1,nL * nF + nL * nL),
+                                     jac=True,
+                                     method=method,
+                                     callback=iteration)
+        finally:
+            self._stopPool()
+        if heldOut is not None and steps[0] % evalEvery != 0:
+            self._recordHeldOut(steps[0], result.x, heldOut)
 
         learnedLabelWeights = np.reshape(result.x[:(nL * nF)], (nL, nF))
         learnedTransProbs   = np.reshape(result.x[(nL * nF):], (nL, nL))
@@ -177,3 +352,103 @@ class CRF:
         self._tps = learnedTransProbs
         return (learnedLabelWeights, learnedTransProbs)
 
+    # length buckets of an (instances, labels) held-out pair, and its size
+    def _packHeldOut(self, heldOut):
+        if heldOut is None:
+            return None
+        return (self._packBatches(heldOut[0], heldOut[1]), len(heldOut[0]))
+
+    # record the average log likelihood of a packed held-out set under the
+    # given parameters after the given step, and pass it to callback if given
+    def _recordHeldOut(self, step, weightsAndTransProbs, heldOut,
+                       callback=None):
+        batches, n = heldOut
+        weights, transProbs = self._unpack(weightsAndTransProbs)
+        ll = (self._sumResults(self._evaluate(batches, weights,
+                                              transProbs))[0] / float(n))
+        self._history.append((step, ll))
+        if callback is not None:
+            callback(step, ll)
+
+    # train this CRF by stochastic gradient ascent on mini-batches, starting
+    # from the current parameters.  batchSource is a function returning an
+    # iterable of (instances, labels) mini-batches and is called once per
+    # epoch (see miniBatches and npzMiniBatches), so only one mini-batch has
+    # to be in memory at a time.  Options:
+    #   method    - 'sgd', 'adagrad' or 'adam'
+    #   alpha     - learning rate
+    #   l2        - strength of the L2 penalty on all parameters
+    #   heldOut   - an (instances, labels) pair whose average log likelihood
+    #               is computed every evalEvery steps and after the last one;
+    #               each (step, log likelihood) is recorded (see
+    #               heldOutHistory) and passed to callback if given
+    def trainStochastic(self, batchSource, method='adam', alpha=0.01,
+                        l2=0.0, epochs=1, heldOut=None, evalEvery=100,
+                        callback=None):
+        assert method in ('sgd', 'adagrad', 'adam'), (
+            "Unknown method: " + str(method))
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+        params = np.concatenate((np.ravel(self._ws), np.ravel(self._tps)))
+        first  = np.zeros_like(params)  # adam mean / adagrad squared sums
+        second = np.zeros_like(params)  # adam uncentered variance
+        heldOut = self._packHeldOut(heldOut)
+
+        def report(step):
+            if heldOut is not None:
+                self._recordHeldOut(step, params, heldOut, callback)
+
+        self._history = []
+        step = 0
+        for epoch in range(epochs):
+            for instances, labels in batchSource():
+                weights, transProbs = self._unpack(params)
+                batches  = self._packBatches(instances, labels)
+                _, grad  = self._sumResults(self._evaluate(batches, weights,
+                                                           transProbs))
+                grad     = grad / float(len(instances)) - l2 * params
+                step    += 1
+
+                if method == 'sgd':
+                    params += alpha * grad
+                elif method == 'adagrad':
+                    first  += grad ** 2
+                    params += alpha * grad / (np.sqrt(first) + eps)
+                else:
+                    first  = beta1 * first + (1.0 - beta1) * grad
+                    second = beta2 * second + (1.0 - beta2) * grad ** 2
+                    params += (alpha * (first / (1.0 - beta1 ** step)) /
+                               (np.sqrt(second / (1.0 - beta2 ** step)) + eps))
+
+                if step % evalEvery == 0:
+                    report(step)
+        if step % evalEvery != 0:
+            report(step)
+
+        self._ws, self._tps = self._unpack(params)
+        return (self._ws, self._tps)
+
+    # (step, held-out average log likelihood) pairs recorded by the last
+    # call to train or trainStochastic
+    def heldOutHistory(self):
+        return self._history
+
+    # MAP label sequences for a list of instances under the current weights.
+    # Instances of the same length are decoded together as one batch.
+    # Returns one dictionary per instance in the same format as the labels
+    # passed to train
+    def predict(self, instances):
+        instances = [ self._featureMatrix(inst) for inst in instances ]
+        byLength  = {}
+        for i, inst in enumerate(instances):
+            byLength.setdefault(inst.shape[0], []).append(i)
+
+        predictions = [ None ] * len(instances)
+        for inds in byLength.values():
+            unary    = np.array([ self._potentials(instances[i], self._ws)
+                                  for i in inds ])
+            paths, _ = viterbi(unary, self._tps)
+            for i, path in zip(inds, paths):
+                predictions[i] = dict([ (self._label(t), int(l))
+                                        for t, l in enumerate(path) ])
+        return predictions
@@ -1,4 +1,147 @@
+import queue
+import threading
 import numpy  as     np
+from   scipy.special import expit
+
+class BatchLoader:
+    """
+    Shuffled mini-batches of binary vectors for BinaryRBM.learn.  The data
+    can be an array, a .npy file (memory-mapped, so it never has to fit in
+    RAM) or a packed-bit .npy file written by savePacked.  Each epoch
+    draws a fresh permutation of the row indices and reads the rows of a
+    batch straight from the source, so the dataset itself is never copied
+    or reordered.  With prefetch on, the next batch is read on a
+    background thread while the caller works on the current one
+    """
+
+    def __init__(self, data, batchSize=None, shuffle=True, nFeatures=None,
+                 dtype=np.float64, prefetch=True, seed=None, nBatches=None):
+        """
+        - data is a 2-D array or the path of a .npy file
+        - batchSize is the largest number of rows in a batch; the rows
+          are split into as few batches as that allows and as evenly as
+          possible, so the sizes of an epoch's batches differ by at most 1
+        - nBatches, instead of batchSize: split every epoch into exactly
+          this many batches (again as evenly as possible)
+        - nFeatures is the number of columns of a packed-bit file (the
+          data is taken to be packed if and only if it is given)
+        - dtype is the dtype of the batches handed out
+        - seed is a seed (or a numpy Generator) for the permutations
+        """
+
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        assert np.ndim(data) == 2, "Data must be a matrix!"
+        assert (batchSize is None) != (nBatches is None), (
+            "Pass exactly one of batchSize and nBatches!")
+
+        self._data      = data
+        self._nFeatures = nFeatures
+        self._shuffle   = shuffle
+        self._dtype     = dtype
+        self._prefetch  = prefetch
+        self._rng       = np.random.default_rng(seed)
+        self._nRows     = np.size(data, 0)
+        if nBatches is None:
+            assert batchSize > 0, "The batch size must be positive!"
+            nBatches = int(np.ceil(self._nRows / float(batchSize)))
+        assert 0 < nBatches <= self._nRows, (
+            "The number of batches must be between 1 and the number of rows!")
+        self._nBatches  = nBatches
+
+    @staticmethod
+    def savePacked(path, data):
+        """
+        Save a binary matrix to path as a .npy file with 8 columns packed
+        into every byte; load it back with nFeatures=np.size(data, 1)
+        """
+
+        np.save(path, np.packbits(np.asarray(data, dtype=np.uint8), axis=1))
+
+    def numRows(self):
+        return self._nRows
+
+    def numFeatures(self):
+        if self._nFeatures is not None:
+            return self._nFeatures
+        return np.size(self._data, 1)
+
+    def maxBatchSize(self):
+        return int(np.ceil(self._nRows / float(self._nBatches)))
+
+    def _read(self, rows):
+        """
+        Read the given rows (in increasing order, which keeps the reads of
+        a memory-mapped file sequential) and convert them to the batch
+        dtype, unpacking the bits of a packed file
+        """
+
+        batch = self._data[np.sort(rows)]
+        if self._nFeatures is not None:
+            batch = np.unpackbits(batch, axis=1)[:, :self._nFeatures]
+        return batch.astype(self._dtype)
+
+    def _epochRows(self):
+        """
+        The row indices of each batch of one epoch
+        """
+
+        if self._shuffle:
+            order = self._rng.permutation(self._nRows)
+        else:
+            order = np.arange(self._nRows)
+        return np.array_split(order, self._nBatches)
+
+    def _background(self, batches):
+        """
+        Yield from the batches generator while a thread reads one batch
+        ahead.  An exception raised while reading is handed over and
+        raised again here
+        """
+
+        ready, stop, done = queue.Queue(maxsize=1), threading.Event(), object()
+        def produce():
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        return
+                    ready.put((True, batch))
+            except Exception as e:
+                ready.put((False, e))
+                return
+            ready.put((True, done))
+
+        worker = threading.Thread(target=produce)
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                ok, batch = ready.get()
+                if not ok:
+                    raise batch
+                if batch is done:
+                    return
+                yield batch
+        finally:
+            stop.set()
+            while worker.is_alive():
+                try:
+                    ready.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+
+    def __len__(self):
+        return self._nBatches
+
+    def __iter__(self):
+        """
+        One epoch of batches
+        """
+
+        batches = (self._read(rows) for rows in self._epochRows())
+        if self._prefetch:
+            return self._background(batches)
+        return batches
 
 class BinaryRBM:
     """
@@ -22,140 +165,499 @@ class BinaryRBM:
         self._oparams   = oparams
         self._hparams   = hparams
         self._pparams   = pairParams
+        self.swapAcceptance = None
+        self._history   = []
 
-    def _pObsGivenHidden(self, hidden):
+    def _pObsGivenHidden(self, hidden, out=None, beta=None):
         """
         Return the probability of the observed variables each taking
-        the value 1 given the hidden variables
+        the value 1 given the hidden variables.  If out is given (a
+        preallocated array of the right shape and dtype) the result is
+        written into it instead of a new array.  If beta is given, the
+        conditionals of the model at inverse temperature beta are used
+        (beta broadcasts against the leading axes of hidden)
         """
 
-        z = np.exp(self._oparams + np.dot(self._pparams, hidden.T).T)
-        return z / (1.0 + z)
+        z = np.dot(hidden, self._pparams.T, out=out)
+        z += self._oparams
+        if beta is not None:
+            z *= beta
+        return expit(z, out=z)
 
-    def _pHiddenGivenObs(self, observed):
+    def _pHiddenGivenObs(self, observed, out=None, beta=None):
         """
         Return the probability of the hidden variables each taking
-        the value 1 given the observed variables
+        the value 1 given the observed variables.  If out is given (a
+        preallocated array of the right shape and dtype) the result is
+        written into it instead of a new array.  If beta is given, the
+        conditionals of the model at inverse temperature beta are used
+        (beta broadcasts against the leading axes of observed)
         """
 
-        z = np.exp(self._hparams + np.dot(self._pparams.T, observed.T).T)
-        return z / (1.0 + z)
+        z = np.dot(observed, self._pparams, out=out)
+        z += self._hparams
+        if beta is not None:
+            z *= beta
+        return expit(z, out=z)
 
-    def _obsGivenHidden(self, hidden):
+    def _sampleInPlace(self, probs, uniform, rng):
         """
-        Draw a sample from the probability of the observed variables given
-        the hidden variables -- P(o=1| h).  This method assumes that the
-        observations are binary and returns a binary vector
+        Turn a matrix of probabilities into a binary sample in place,
+        using uniform (a preallocated matrix of the same shape) as
+        scratch space for the random draws
         """
 
-        probs   = self._pObsGivenHidden(hidden)
-        samples = np.reshape(np.random.rand(np.size(probs)), probs.shape)
-        return ((probs - samples) >= 0).astype(int)
+        rng.random(out=uniform, dtype=uniform.dtype)
+        return np.less(uniform, probs, out=probs)
 
-    def _hiddenGivenObs(self, observed):
+    def energy(self, observed, hidden):
         """
-        Draw a sample from the probability of the hidden variables given the
-        observed variables -- P(h=1| o).  This method assumes that the hidden
-        variables are binary and returns a binary vector
+        Return the energy of each row of a (matrix of) observed and hidden
+        settings
         """
 
-        probs   = self._pHiddenGivenObs(observed)
-        samples = np.reshape(np.random.rand(np.size(probs)), probs.shape)
-        print(probs)
-        return ((probs - samples) >= 0).astype(int)
+        return (- np.sum(np.dot(observed, self._pparams) * hidden, -1)
+                - np.dot(hidden, self._hparams)
+                - np.dot(observed, self._oparams))
 
-    def blockGibbs(self, s):
+    def _gibbsChains(self, nChains, burnIn, thin, rng):
         """
-        pass in the number of iterations; thiscontinually draws
-        samples of the hidden variables given the observed variables
-        *AND THEN DRAWS NEW OBSERVED VARIABLES GIVEN A SAMPLE OF HIDDEN VARS*
-        This algorithm uses block gibbs sampling
+        Run nChains block Gibbs chains side by side as one matrix, starting
+        from random hidden settings.  After burnIn sweeps, yields the
+        (observed, hidden) buffers after every thin-th sweep; the buffers
+        are overwritten by the next sweep
         """
 
+        dtype = self._pparams.dtype
+        obs, obsRand = np.empty((2, nChains, self._nobserved), dtype=dtype)
+        hid, hidRand = np.empty((2, nChains, self._nhidden), dtype=dtype)
+        hid[...] = rng.integers(2, size=hid.shape)
+
+        sweep = 0
+        while True:
+            self._pObsGivenHidden(hid, out=obs)
+            self._sampleInPlace(obs, obsRand, rng)
+            self._pHiddenGivenObs(obs, out=hid)
+            self._sampleInPlace(hid, hidRand, rng)
+            sweep += 1
+            if sweep > burnIn and (sweep - burnIn) % thin == 0:
+                yield obs, hid
+
+    def _swapReplicas(self, obs, hid, betas, parity, rng, stats):
+        """
+        Propose swapping the states of neighbouring temperatures i and i+1
+        (for every i with the given parity) in every chain at once; obs and
+        hid are (temperatures x chains x variables).  stats is an
+        (attempted, accepted) pair of per-neighbour counters updated in
+        place
+        """
 
+        lower = np.arange(parity, len(betas) - 1, 2)
+        if len(lower) == 0:
+            return
+        energy   = self.energy(obs[:-1], hid[:-1]) - self.energy(obs[1:],
+                                                              hid[1:])
+        logRatio = ((betas[lower] - betas[lower + 1])[:, np.newaxis] *
+                    energy[lower])
+        accept   = np.log(rng.random(logRatio.shape)) < logRatio
 
-        # Initialize
-        oSamples = [ self._obsGivenHidden(
-                np.random.randint(2, size=self._nhidden)) ]
-        hSamples = [ self._hiddenGivenObs(oSamples[-1]) ]
+        pairs, chains = np.nonzero(accept)
+        lo, hi = lower[pairs], lower[pairs] + 1
+        obs[lo, chains], obs[hi, chains] = obs[hi, chains], obs[lo, chains]
+        hid[lo, chains], hid[hi, chains] = hid[hi, chains], hid[lo, chains]
 
-        for i in range(s-1):
-            oSamples.append(self._obsGivenHidden(hSamples[-1]))
-            hSamples.append(self._hiddenGivenObs(oSamples[-1]))
+        stats[0][lower] += np.size(accept, 1)
+        stats[1][lower] += np.sum(accept, 1)
 
-            print(-np.dot(np.dot(self._pparams,hSamples[-1]),oSamples[-1])
-                   - np.dot(self._hparams, hSamples[-1])
-                   - np.dot(self._oparams, oSamples[-1]))
+    def _temperingChains(self, betas, nChains, burnIn, thin, rng, stats):
+        """
+        Like _gibbsChains, but each chain is a ladder of replicas at the
+        inverse temperatures betas (the first of which should be 1), all
+        updated as one matrix and followed by a round of replica swaps
+        alternating between even and odd neighbours.  Yields the state of
+        the first replica of every chain
+        """
 
+        dtype = self._pparams.dtype
+        shape = (len(betas), nChains)
+        beta  = np.reshape(betas, (-1, 1, 1)).astype(dtype)
+        obs, obsRand = np.empty((2,) + shape + (self._nobserved,), dtype=dtype)
+        hid, hidRand = np.empty((2,) + shape + (self._nhidden,), dtype=dtype)
+        hid[...] = rng.integers(2, size=hid.shape)
+
+        sweep = 0
+        while True:
+            self._pObsGivenHidden(hid, out=obs, beta=beta)
+            self._sampleInPlace(obs, obsRand, rng)
+            self._pHiddenGivenObs(obs, out=hid, beta=beta)
+            self._sampleInPlace(hid, hidRand, rng)
+            self._swapReplicas(obs, hid, betas, sweep % 2, rng, stats)
+            sweep += 1
+            if sweep > burnIn and (sweep - burnIn) % thin == 0:
+                yield obs[0], hid[0]
+
+    def _takeSamples(self, chains, s, nChains, out, energies):
+        """
+        Copy the next s states of the chains generator into out (or new
+        arrays), appending their energies if asked
+        """
+
+        dtype = self._pparams.dtype
+        if out is None:
+            out = (np.empty((s, nChains, self._nobserved), dtype=dtype),
+                   np.empty((s, nChains, self._nhidden), dtype=dtype))
+        oSamples, hSamples = out
+        assert oSamples.shape == (s, nChains, self._nobserved), (
+            "Observed output has the wrong shape!")
+        assert hSamples.shape == (s, nChains, self._nhidden), (
+            "Hidden output has the wrong shape!")
+
+        for i in range(s):
+            oSamples[i], hSamples[i] = next(chains)
+
+        if energies:
+            return oSamples, hSamples, self.energy(oSamples, hSamples)
         return oSamples, hSamples
 
-    def learn(self, train, T, B, C, alpha, reg):
+    def blockGibbs(self, s, nChains=1, burnIn=0, thin=1, out=None,
+                   energies=False, seed=None):
+        """
+        Draw s samples from each of nChains block Gibbs chains: every sweep
+        draws the observed variables given the hidden ones *AND THEN* the
+        hidden variables given the new observed ones.
+        - burnIn, number of sweeps to throw away first
+        - thin, keep only every thin-th sweep after that
+        - out, optional preallocated (observed, hidden) arrays of shapes
+          (s, nChains, nobserved) and (s, nChains, nhidden) to write into
+        - energies, also return the (s, nChains) energy of every sample
+        - seed, seed for the random number generator
+
+        Returns the observed and hidden samples (and the energies if asked)
+        """
+
+        chains = self._gibbsChains(nChains, burnIn, thin,
+                                   np.random.default_rng(seed))
+        return self._takeSamples(chains, s, nChains, out, energies)
+
+    def parallelTempering(self, s, betas=None, nTemps=10, nChains=1,
+                          burnIn=0, thin=1, out=None, energies=False,
+                          seed=None):
+        """
+        Same as blockGibbs, but every chain runs a ladder of replicas at the
+        inverse temperatures betas (by default nTemps evenly spaced ones
+        from 1 down to 1/nTemps) and swaps states between neighbouring
+        temperatures after every sweep, so the chains can cross between
+        modes through the flatter, hotter distributions.  Only the samples
+        of the beta = 1 replicas are returned; the fraction of accepted
+        swaps between each pair of neighbouring temperatures is left in
+        swapAcceptance
+        """
+
+        betas = self._temperatures(betas, nTemps)
+        stats = np.zeros((2, len(betas) - 1))
+        chains = self._temperingChains(betas, nChains, burnIn, thin,
+                                       np.random.default_rng(seed), stats)
+        samples = self._takeSamples(chains, s, nChains, out, energies)
+        self.swapAcceptance = stats[1] / np.maximum(stats[0], 1)
+        return samples
+
+    def _temperatures(self, betas, nTemps):
+        """
+        The ladder of inverse temperatures to use, hottest last
+        """
+
+        if betas is None:
+            betas = np.linspace(1.0, 0.0, nTemps, endpoint=False)
+        betas = np.asarray(betas, dtype=float)
+        assert betas[0] == 1.0, "The first temperature must be 1!"
+        assert np.all((betas > 0) & (betas <= 1)), (
+            "Inverse temperatures must be in (0, 1]!")
+        return betas
+
+    def sampleStream(self, s, batchSize, nChains=1, burnIn=0, thin=1,
+                     energies=False, seed=None):
+        """
+        Like blockGibbs, but a generator that yields the s samples of every
+        chain batchSize at a time, so memory does not grow with s.  Each
+        batch is a tuple of (b, nChains, ...) arrays with b <= batchSize
+        """
+
+        chains = self._gibbsChains(nChains, burnIn, thin,
+                                   np.random.default_rng(seed))
+        for start in range(0, s, batchSize):
+            yield self._takeSamples(chains, min(batchSize, s - start),
+                                    nChains, None, energies)
+
+    def freeEnergy(self, observed):
+        """
+        Return the free energy of each row of observed: minus the log of
+        the unnormalized probability of the observed setting with the
+        hidden units summed out
+        """
+
+        return (- np.dot(observed, self._oparams)
+                - np.sum(np.logaddexp(0, np.dot(observed, self._pparams) +
+                                      self._hparams), -1))
+
+    def pseudoLogLikelihood(self, observed, seed=None):
+        """
+        Stochastic estimate of the average pseudo-log-likelihood of the
+        rows of observed: for each row, the log probability of one randomly
+        chosen observed variable given the others, times the number of
+        observed variables
+        """
+
+        observed = np.asarray(observed, dtype=self._pparams.dtype)
+        rows     = np.arange(np.size(observed, 0))
+        flip     = np.random.default_rng(seed).integers(self._nobserved,
+                                                        size=len(rows))
+        flipped  = observed.copy()
+        flipped[rows, flip] = 1 - flipped[rows, flip]
+
+        gap = self.freeEnergy(flipped) - self.freeEnergy(observed)
+        return self._nobserved * np.mean(-np.logaddexp(0, -gap))
+
+    def logPartition(self, nRuns=100, nBetas=1000, seed=None):
+        """
+        Annealed importance sampling estimate of the log of the partition
+        function.  nRuns runs are annealed side by side as one matrix from
+        the uniform distribution (beta = 0) to the model (beta = 1) through
+        nBetas evenly spaced inverse temperatures, with one tempered block
+        Gibbs sweep per temperature.  Returns the estimate and its
+        (approximate) standard error, which is large when the runs disagree
+        """
+
+        rng   = np.random.default_rng(seed)
+        dtype = self._pparams.dtype
+        betas = np.linspace(0.0, 1.0, nBetas + 1)
+        obs, obsRand = np.empty((2, nRuns, self._nobserved), dtype=dtype)
+        hid, hidRand = np.empty((2, nRuns, self._nhidden), dtype=dtype)
+        obs[...] = rng.integers(2, size=obs.shape)
+
+        # log of the unnormalized marginal of the observed units under the
+        # model at inverse temperature beta
+        def logF(beta):
+            return beta * np.dot(obs, self._oparams) + np.sum(np.logaddexp(
+                0, beta * (np.dot(obs, self._pparams) + self._hparams)), -1)
+
+        logWeights = np.zeros(nRuns)
+        for prev, beta in zip(betas[:-1], betas[1:]):
+            logWeights += logF(beta) - logF(prev)
+            self._pHiddenGivenObs(obs, out=hid, beta=beta)
+            self._sampleInPlace(hid, hidRand, rng)
+            self._pObsGivenHidden(hid, out=obs, beta=beta)
+            self._sampleInPlace(obs, obsRand, rng)
+
+        logZ0  = (self._nobserved + self._nhidden) * np.log(2)
+        top    = logWeights.max()
+        ratios = np.exp(logWeights - top)
+        logZ   = logZ0 + top + np.log(np.mean(ratios))
+        return logZ, np.std(ratios) / np.mean(ratios) / np.sqrt(nRuns)
+
+    def avgLogLikelihood(self, observed, logZ=None, **aisOptions):
+        """
+        Average log-likelihood of the rows of observed; log Z is estimated
+        with logPartition (passing on aisOptions) unless given
+        """
+
+        if logZ is None:
+            logZ = self.logPartition(**aisOptions)[0]
+        return -np.mean(self.freeEnergy(observed)) - logZ
+
+    def heldOutHistory(self):
+        """
+        The (epoch, score) pairs computed on the held-out set during the
+        last call to learn
+        """
+
+        return self._history
+
+    def learn(self, train, T, B, C, alpha, reg, k=1, persistent=True,
+              momentum=0.0, dtype=np.float64, seed=None, verbose=False,
+              shuffle=True, tempering=False, betas=None, nTemps=10,
+              heldOut=None, evalEvery=1, patience=None, metric='loglik',
+              aisRuns=100, aisBetas=1000):
         """
         Trains the weights of a binary rbm; learning done using batch
         stochastic gradient ascent
-        - train is the training set
-        - T, number of learning iterations
-        - C, number of chains to run
-        - B, number of batches
+        - train is the training set: a matrix, the path of a .npy file or
+          a BatchLoader (which then decides the batches and B is ignored)
+        - T, number of learning iterations (epochs)
+        - C, number of chains to run (persistent mode only)
+        - B, number of batches per epoch
         - alpha, learning rate
-        - reg, regularization
+        - reg, regularization (weight decay)
+        - k, number of Gibbs steps per gradient estimate
+        - persistent, run persistent chains across updates (PCD) instead
+          of restarting them at the data each batch (CD-k)
+        - momentum, fraction of the previous update added to the next one
+        - dtype, np.float32 or np.float64 for parameters and buffers
+        - seed, seed for the random number generator
+        - shuffle, visit the rows in a new random order every epoch
+        - tempering, run the persistent chains as parallel tempering
+          ladders (see parallelTempering for betas and nTemps); the swap
+          acceptance rates are left in swapAcceptance
+        - heldOut, a matrix of held-out rows scored every evalEvery epochs
+          and after the last one; metric 'loglik' is the average
+          log-likelihood (log Z by AIS with aisRuns runs and aisBetas
+          temperatures) and 'pseudo' the pseudo-log-likelihood.  The
+          scores are kept (see heldOutHistory)
+        - patience, stop after this many evaluations without improvement
+          and go back to the best parameters seen
+
+        Returns the final (observed, hidden) samples of the negative
+        chains; in CD-k mode there is one row per row of the last batch.
+
+        Every array the training loop needs is allocated once up front and
+        updated in place afterwards.
         """
 
-        ntrain      = np.size(train, 0)
-        batchSize   = np.floor(ntrain / B).astype(int)
-        batchStarts = np.append(np.arange(0, ntrain, batchSize), ntrain)
-
-        hidSamps = np.random.randint(2, size=(C, self._nhidden))
-        obsSamps = np.zeros((C, self._nobserved))
+        rng = np.random.default_rng(seed)
+        if not isinstance(train, BatchLoader):
+            if isinstance(train, str):
+                train = np.load(train, mmap_mode='r')
+            train = BatchLoader(train, nBatches=B, shuffle=shuffle,
+                                dtype=dtype, seed=rng)
+        assert train.numFeatures() == self._nobserved, (
+            "Training data must have one column per observed variable!")
+        maxBatch = train.maxBatchSize()
+        nO, nH   = self._nobserved, self._nhidden
 
         # initiliaze params
-        self._hparams = np.random.normal(0, 0.1**2, self._nhidden)
-        self._oparams = np.random.normal(0, 0.1**2, self._nobserved)
-        self._pparams = np.random.normal(0, 0.1**2, (self._nobserved,
-                                                     self._nhidden))
+        self._hparams = rng.normal(0, 0.1**2, nH).astype(dtype)
+        self._oparams = rng.normal(0, 0.1**2, nO).astype(dtype)
+        self._pparams = rng.normal(0, 0.1**2, (nO, nH)).astype(dtype)
+
+        # preallocated buffers: the current batch, positive-phase hidden
+        # probabilities, the negative chains (and scratch for their random
+        # draws), the gradients and the momentum velocities
+        # (with tempering, the chains get a leading temperature axis)
+        nChains = C if persistent else maxBatch
+        m       = nChains  # chains the last batch used
+        ladder  = ()
+        if tempering:
+            assert persistent, "Tempering needs persistent chains!"
+            betas  = self._temperatures(betas, nTemps)
+            beta   = np.reshape(betas, (-1, 1, 1)).astype(dtype)
+            stats  = np.zeros((2, len(betas) - 1))
+            ladder = (len(betas),)
+            sweep  = 0  # runs across batches so swaps keep alternating
+        batch   = np.empty((maxBatch, nO), dtype=dtype)
+        posHid  = np.empty((maxBatch, nH), dtype=dtype)
+        obsSamps, obsRand = np.empty((2,) + ladder + (nChains, nO),
+                                     dtype=dtype)
+        hidSamps, hidRand = np.empty((2,) + ladder + (nChains, nH),
+                                     dtype=dtype)
+        gOparams, vOparams = np.zeros((2, nO), dtype=dtype)
+        gHparams, vHparams = np.zeros((2, nH), dtype=dtype)
+        gPparams, vPparams = np.zeros((2, nO, nH), dtype=dtype)
+        negOparams = np.empty(nO, dtype=dtype)
+        negHparams = np.empty(nH, dtype=dtype)
+        negPparams = np.empty((nO, nH), dtype=dtype)
+
+        obsSamps[...] = rng.integers(2, size=obsSamps.shape)
+
+        assert metric in ('loglik', 'pseudo'), "Unknown metric: " + metric
+        def score():
+            if metric == 'pseudo':
+                return self.pseudoLogLikelihood(heldOut, seed=rng)
+            return self.avgLogLikelihood(heldOut, nRuns=aisRuns,
+                                         nBetas=aisBetas, seed=rng)
+        self._history = []
+        best, bestParams, waited = -np.inf, None, 0
+
         for t in range(T):
-            for b in range(np.size(batchStarts) - 1):
-                print("Iteration: " + str(t) + " Batch number: " + str(b))
-                currBatch = train[batchStarts[b] : batchStarts[b+1], :]
+            for b, data in enumerate(train):
+                if verbose:
+                    print("Iteration: " + str(t) + " Batch number: " + str(b))
+                n = np.size(data, 0)
+                m = nChains if persistent else n
+                currBatch = batch[:n]
+                currBatch[...] = data
 
                 # Calculate the positive gradient pieces
-                p_gOparams = np.sum(currBatch, 0)
-                p_gHparams = np.zeros(self._nhidden)
-                p_gPparams = np.zeros((self._nobserved, self._nhidden))
-
-                probs      = self._pHiddenGivenObs(currBatch)
-                p_gHparams = np.sum(probs, 0)
-                p_gPparams = p_gPparams + np.dot(currBatch.T, probs)
-
-                # Calculate the negative gradient pieces
-                n_gOparams = np.zeros(self._nobserved)
-                n_gHparams = np.zeros(self._nhidden)
-                n_gPparams = np.zeros((self._nobserved, self._nhidden))
-
-                obsSamps = self._obsGivenHidden(hidSamps)
-                hidSamps = self._hiddenGivenObs(obsSamps)
-
-                n_gOparams = np.sum(obsSamps, 0)
-                probs      = self._pHiddenGivenObs(obsSamps)
-                n_gHparams = np.sum(probs, 0)
-                n_gPparams = np.dot(obsSamps.T, probs)
-
-                # Take Gradient Steps
-                self._oparams = (self._oparams +
-                                 alpha * (p_gOparams / np.size(currBatch, 0)
-                                          - n_gOparams / C
-                                          - reg * self._oparams))
-
-                self._hparams = (self._hparams +
-                                 alpha * (p_gHparams / np.size(currBatch, 0)
-                                          - n_gHparams / C
-                                          - reg * self._hparams))
-
-                self._pparams = (self._pparams +
-                                 alpha * (p_gPparams / np.size(currBatch, 0)
-                                          - n_gPparams / C
-                                          - reg * self._pparams))
-
+                probs = self._pHiddenGivenObs(currBatch, out=posHid[:n])
+                np.dot(currBatch.T, probs, out=gPparams)
+                gPparams /= n
+                np.sum(currBatch, 0, out=gOparams)
+                gOparams /= n
+                np.sum(probs, 0, out=gHparams)
+                gHparams /= n
+
+                # Run the negative chains k steps (restarting them at the
+                # data for CD-k) and subtract the negative gradient pieces
+                if tempering:
+                    for step in range(k):
+                        self._pHiddenGivenObs(obsSamps, out=hidSamps,
+                                              beta=beta)
+                        self._sampleInPlace(hidSamps, hidRand, rng)
+                        self._pObsGivenHidden(hidSamps, out=obsSamps,
+                                              beta=beta)
+                        self._sampleInPlace(obsSamps, obsRand, rng)
+                        self._swapReplicas(obsSamps, hidSamps, betas,
+                                           sweep % 2, rng, stats)
+                        sweep += 1
+                    obs, hid = obsSamps[0], hidSamps[0]
+                else:
+                    obs, hid = obsSamps[:m], hidSamps[:m]
+                    if not persistent:
+                        obs[...] = currBatch
+                    for step in range(k):
+                        self._pHiddenGivenObs(obs, out=hid)
+                        self._sampleInPlace(hid, hidRand[:m], rng)
+                        self._pObsGivenHidden(hid, out=obs)
+                        self._sampleInPlace(obs, obsRand[:m], rng)
+                probs = self._pHiddenGivenObs(obs, out=hid)
+
+                np.dot(obs.T, probs, out=negPparams)
+                np.sum(obs, 0, out=negOparams)
+                np.sum(probs, 0, out=negHparams)
+                for (grad, neg) in [ (gOparams, negOparams),
+                                     (gHparams, negHparams),
+                                     (gPparams, negPparams) ]:
+                    neg  /= m
+                    grad -= neg
+
+                # Take Gradient Steps (the weight decay term reuses the
+                # gradient buffer once the gradient is in the velocity)
+                for (param, grad, velocity) in [
+                        (self._oparams, gOparams, vOparams),
+                        (self._hparams, gHparams, vHparams),
+                        (self._pparams, gPparams, vPparams) ]:
+                    grad     *= alpha
+                    velocity *= momentum
+                    velocity += grad
+                    np.multiply(param, alpha * reg, out=grad)
+                    velocity -= grad
+                    param    += velocity
+
+            if heldOut is None or ((t + 1) % evalEvery != 0 and t + 1 < T):
+                continue
+            self._history.append((t + 1, score()))
+            if verbose:
+                print("Epoch: " + str(t + 1) + " Held-out " + metric + ": " +
+                      str(self._history[-1][1]))
+            if self._history[-1][1] > best:
+                best, waited = self._history[-1][1], 0
+                bestParams = [ p.copy() for p in (self._oparams,
+                                                  self._hparams,
+                                                  self._pparams) ]
+            else:
+                waited += 1
+                if patience is not None and waited >= patience:
+                    break
+
+        if patience is not None and bestParams is not None:
+            self._oparams, self._hparams, self._pparams = bestParams
+
+        if tempering:
+            self.swapAcceptance = stats[1] / np.maximum(stats[0], 1)
+            obsSamps, hidSamps = obsSamps[0], hidSamps[0]
+            hidRand = hidRand[0]
+        elif not persistent:
+            # only the first m rows were restarted at the last batch; the
+            # rest still hold an earlier, larger batch's chains
+            obsSamps, hidSamps, hidRand = (obsSamps[:m], hidSamps[:m],
+                                           hidRand[:m])
+        self._sampleInPlace(hidSamps, hidRand, rng)
         return obsSamps, hidSamps
-
-
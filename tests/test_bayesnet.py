@@ -0,0 +1,89 @@
+import itertools
+
+import numpy as np
+
+from BayesNet import BayesNet
+
+def randomData(seed, n):
+    return np.random.default_rng(seed).integers(0, [2, 3, 2], size=(n, 3))
+
+def network():
+    return BayesNet(['a', 'b', 'c'], [2, 3, 2],
+                    [['a'], ['b', 'a'], ['c', 'a', 'b']])
+
+# P(a, b, c) as an array, one product of CPT entries per joint setting
+def enumeratedJoint(bn):
+    joint = np.zeros((2, 3, 2))
+    for a, b, c in itertools.product(range(2), range(3), range(2)):
+        joint[a, b, c] = np.prod([ cpt.probs([ { 'a' : a, 'b' : b,
+                                                 'c' : c }[v]
+                                               for v in cpt.getVars() ])
+                                   for cpt in bn._cpts ])
+    return joint
+
+def test_learned_cpts_are_conditional_frequencies():
+    data = randomData(0, 500)
+    bn   = network()
+    bn.learn(data)
+    cpt  = bn._cpts[2]
+    rows = data[(data[:, 0] == 1) & (data[:, 1] == 0)]
+    assert np.isclose(cpt.probs((1, 1, 0)), np.mean(rows[:, 2] == 1))
+
+def test_partial_fits_and_merges_match_learn():
+    data  = randomData(2, 300)
+    whole = network()
+    whole.learn(data)
+    parts = [ network() for i in range(3) ]
+    for part, chunk in zip(parts, np.array_split(data, 3)):
+        part.partialFit(chunk)
+    merged = parts[0].merge(parts[1]).merge(parts[2])
+    for a, b in zip(whole._cpts, merged._cpts):
+        assert np.allclose(a._probs, b._probs)
+
+def test_learn_parallel_matches_learn(tmpdir):
+    data = randomData(3, 1000)
+    path = str(tmpdir.join('data.npy'))
+    np.save(path, data)
+    serial = network()
+    serial.learn(data)
+    for nWorkers, chunkRows in [ (1, 1000), (2, 128), (3, 77) ]:
+        parallel = network()
+        parallel.learnParallel(path, nWorkers, chunkRows)
+        for a, b in zip(serial._cpts, parallel._cpts):
+            assert np.array_equal(a._counts, b._counts)
+            assert np.allclose(a._probs, b._probs, equal_nan=True)
+
+def test_query_matches_enumerating_the_joint():
+    data = randomData(1, 500)
+    bn   = network()
+    bn.learn(data)
+
+    joint    = enumeratedJoint(bn)
+    expected = joint[:, :, 1].sum(axis=1) / joint[:, :, 1].sum()
+    assert np.allclose(bn.query(['a'], { 'c' : 1 })._factor, expected)
+
+def test_samples_match_the_enumerated_joint():
+    bn = network()
+    for seed in [ 2, 3 ]:
+        bn.learn(randomData(seed, 300))
+        n       = 100000
+        samples = bn.sample(n, seed=seed)
+        assert np.array_equal(samples, bn.sample(n, seed=seed))
+
+        joint  = enumeratedJoint(bn)
+        counts = np.zeros((2, 3, 2))
+        np.add.at(counts, tuple(samples.T), 1)
+        # within 5 standard errors of every cell's probability
+        assert np.all(np.abs(counts / n - joint) <
+                      5 * np.sqrt(joint * (1 - joint) / n))
+
+def test_likelihood_weighting_matches_the_enumerated_joint():
+    bn = network()
+    bn.learn(randomData(4, 300))
+    joint    = enumeratedJoint(bn)
+    expected = joint[:, :, 0] / joint[:, :, 0].sum()
+
+    estimate = bn.likelihoodWeighting(['a', 'b'], { 'c' : 0 }, 100000,
+                                      seed=0)
+    assert np.allclose(estimate._factor, expected, atol=0.01)
+    assert np.allclose(bn.query(['a', 'b'], { 'c' : 0 })._factor, expected)
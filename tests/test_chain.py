@@ -0,0 +1,107 @@
+import itertools
+
+import numpy as np
+
+from CliqueChain import CalibratedChain, CliqueChain
+from Factor      import Factor
+
+VARS = [ 'a', 'b', 'c', 'd', 'e', 'f' ]
+
+def randomChain(seed, n=4, domain=3):
+    rng = np.random.default_rng(seed)
+    return [ Factor([ VARS[i], VARS[i + 1] ], [ domain, domain ],
+                    rng.normal(size=(domain, domain))) for i in range(n) ]
+
+def joint(cliques):
+    return Factor.product(cliques)
+
+def assignments(factor):
+    for setting in itertools.product(*[ range(d) for d in factor._domains ]):
+        yield dict(zip(factor.varOrdering(), setting))
+
+def test_log_likelihoods_match_the_joint():
+    cliques = randomChain(0)
+    chain   = CliqueChain(cliques)
+    full    = joint(cliques)
+    logZ    = full.logZ()
+
+    assert np.isclose(chain.logZ(), logZ)
+    every   = list(assignments(full))
+    batched = chain.logLikelihoods(every)
+    for assignment, score in zip(every, batched):
+        expected = full.get(assignment) - logZ
+        assert np.isclose(chain.logLikelihood(assignment), expected)
+        assert np.isclose(score, expected)
+
+def test_marginals_match_the_joint():
+    cliques   = randomChain(1)
+    full      = joint(cliques)
+    marginals = CliqueChain(cliques).allMarginals()
+    for v in full.varOrdering():
+        assert np.allclose(marginals[v]._factor,
+                           full.marginal([v]).toProbs()._factor)
+
+def test_max_product_finds_the_best_joint_assignment():
+    for seed in range(5):
+        cliques = randomChain(seed)
+        full    = joint(cliques)
+        best    = max(assignments(full), key=full.get)
+        assignment, score = CliqueChain(cliques).maxProduct()
+        assert assignment == best
+        assert np.isclose(score, full.get(best))
+
+def checkCalibrated(chain):
+    full = joint(chain._cliques)
+    assert np.isclose(chain.logZ(), full.logZ())
+    for v in full.varOrdering():
+        assert np.allclose(chain.marginal(v)._factor,
+                           full.marginal([v]).toProbs()._factor)
+
+def countMessages(chain):
+    calls   = [ 0 ]
+    message = chain.message
+    def counted(f1, f2):
+        calls[0] += 1
+        return message(f1, f2)
+    chain.message = counted
+    return calls
+
+def test_calibrated_chain_matches_brute_force_after_changes():
+    rng   = np.random.default_rng(2)
+    chain = CalibratedChain(randomChain(2))
+    checkCalibrated(chain)
+    chain.setPotential(1, Factor([ 'b', 'c' ], [ 3, 3 ],
+                                 rng.normal(size=(3, 3))))
+    checkCalibrated(chain)
+    chain.observe('c', 1)
+    checkCalibrated(chain)
+    chain.observe('e', 2)
+    checkCalibrated(chain)
+
+def test_calibrated_chain_only_recomputes_stale_messages():
+    rng   = np.random.default_rng(3)
+    chain = CalibratedChain(randomChain(3, n=5))
+    calls = countMessages(chain)
+    chain.sumProduct()
+    assert calls[0] == 8  # 4 forward and 4 backward messages
+
+    calls[0] = 0
+    chain.sumProduct()
+    assert calls[0] == 0
+
+    # a new potential for the last clique makes only the backward messages
+    # leaving it stale
+    chain.setPotential(4, Factor([ 'e', 'f' ], [ 3, 3 ],
+                                 rng.normal(size=(3, 3))))
+    chain.marginal('f')
+    assert calls[0] == 0
+    chain.marginal('a')
+    assert calls[0] == 4
+
+    # a change in the middle leaves the messages flowing into it intact
+    calls[0] = 0
+    chain.setPotential(2, Factor([ 'c', 'd' ], [ 3, 3 ],
+                                 rng.normal(size=(3, 3))))
+    chain.sumProduct()
+    assert calls[0] == 4  # C2 -> C3, C3 -> C4, C2 -> C1, C1 -> C0
+    checkCalibrated(chain)
@@ -0,0 +1,35 @@
+import itertools
+
+import numpy as np
+
+from CPT import CPT
+
+def learnedCPT(seed):
+    cpt  = CPT([ 'c', 'p', 'q' ], [ 3, 2, 4 ])
+    rng  = np.random.default_rng(seed)
+    cpt.learn(rng.integers(0, [ 3, 2, 4 ], size=(400, 3)))
+    return cpt
+
+def test_bulk_probs_match_single_lookups():
+    cpt      = learnedCPT(0)
+    settings = list(itertools.product(range(3), range(2), range(4)))
+    assert np.allclose(cpt.bulkProbs(settings),
+                       [ cpt.probs(s) for s in settings ])
+    assert np.allclose(np.sum(cpt._probs, axis=0), 1.0)
+
+# marginalize sums the probabilities of the settings that agree on the kept
+# variables and renormalizes over the child, one setting at a time
+def referenceMarginal(cpt, toKeep):
+    kept   = sorted([ cpt.getVars().index(v) for v in toKeep ])
+    table  = np.zeros([ cpt._domains[i] for i in kept ])
+    for setting in itertools.product(*[ range(d) for d in cpt._domains ]):
+        table[tuple(setting[i] for i in kept)] += cpt.probs(setting)
+    return table / np.sum(table, axis=0, keepdims=True)
+
+def test_marginalize_matches_setting_by_setting_sums():
+    cpt = learnedCPT(1)
+    for toKeep in [ ['c', 'q'], ['q', 'c'], ['c'], ['p', 'q'], ['c', 'p'] ]:
+        marginal = cpt.marginalize(toKeep)
+        assert marginal.getVars() == [ v for v in cpt.getVars()
+                                       if v in toKeep ]
+        assert np.allclose(marginal._probs, referenceMarginal(cpt, toKeep))
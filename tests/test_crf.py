@@ -0,0 +1,167 @@
+import itertools
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from crf         import CRF, miniBatches, npzMiniBatches
+from LinearChain import viterbi
+
+L, F = 3, 4
+
+def randomProblem(seed, n=12, maxLength=5):
+    rng     = np.random.default_rng(seed)
+    insts   = [ (rng.random(size=(int(rng.integers(2, maxLength + 1)), F)) <
+                 0.4).astype(float) for i in range(n) ]
+    labels  = [ dict([ ('label' + str(t), int(rng.integers(L)))
+                       for t in range(len(x)) ]) for x in insts ]
+    crf     = CRF(np.zeros((L, F)), np.zeros((L, L)), insts, labels)
+    params  = rng.normal(size=L * F + L * L)
+    return crf, insts, labels, params
+
+def test_predict_matches_clique_chain_max_product():
+    crf, insts, labels, params = randomProblem(5)
+    crf._ws  = np.reshape(params[:L * F], (L, F))
+    crf._tps = np.reshape(params[L * F:], (L, L))
+    for inst, predicted in zip(insts, crf.predict(insts)):
+        chain = crf._instance2Chain(inst, crf._ws, crf._tps)
+        assert predicted == chain.maxProduct()[0]
+
+def test_gradient_matches_finite_differences():
+    crf, insts, labels, params = randomProblem(0)
+    grad = crf._jacobian(params)
+
+    eps     = 1e-6
+    numeric = np.zeros_like(params)
+    for i in range(len(params)):
+        step        = np.zeros_like(params)
+        step[i]     = eps
+        numeric[i]  = (crf._objective(params + step) -
+                       crf._objective(params - step)) / (2 * eps)
+    assert np.allclose(grad, numeric, atol=1e-5)
+
+def test_batched_likelihood_matches_clique_chains():
+    crf, insts, labels, params = randomProblem(1)
+    weights, transProbs = crf._unpack(params)
+    expected = np.mean([ crf.instanceLogLikelihood(x, y, weights, transProbs)
+                         for x, y in zip(insts, labels) ])
+    assert np.isclose(crf.avgLogLikelihood(insts, labels, weights,
+                                           transProbs), expected)
+    assert np.isclose(-crf._objective(params), expected)
+
+def test_value_and_gradient_share_one_evaluation():
+    crf, insts, labels, params = randomProblem(6)
+    calls = [ 0 ]
+    valueAndGrad = crf._valueAndGrad
+    def counted(x):
+        calls[0] += 1
+        return valueAndGrad(x)
+    crf._valueAndGrad = counted
+
+    crf._objective(params)
+    crf._jacobian(params)
+    assert calls[0] == 1
+    crf._jacobian(params + 1.0)
+    crf._objective(params)
+    assert calls[0] == 2
+
+def test_parallel_training_matches_serial():
+    results = []
+    for nWorkers in [ None, 2, 3 ]:
+        crf, insts, labels, params = randomProblem(4, n=30)
+        crf._BUCKET_SIZE = 7
+        np.random.seed(0)
+        results.append(crf.train(insts, labels, nWorkers=nWorkers))
+    for weights, transProbs in results[1:]:
+        assert np.array_equal(weights, results[0][0])
+        assert np.array_equal(transProbs, results[0][1])
+
+def test_index_array_labels_match_label_dictionaries():
+    crf, insts, labels, params = randomProblem(7)
+    weights, transProbs = crf._unpack(params)
+    arrays = [ [ y['label' + str(t)] for t in range(len(x)) ]
+               for x, y in zip(insts, labels) ]
+    assert np.isclose(crf.avgLogLikelihood(insts, arrays, weights,
+                                           transProbs),
+                      crf.avgLogLikelihood(insts, labels, weights,
+                                           transProbs))
+
+def test_npz_mini_batches_round_trip(tmpdir):
+    crf, insts, labels, params = randomProblem(8)
+    paths = []
+    for i, part in enumerate([ slice(0, 5), slice(5, None) ]):
+        path = str(tmpdir.join('part' + str(i) + '.npz'))
+        np.savez(path, feats=np.vstack(insts[part]),
+                 labels=np.concatenate([
+                     [ y['label' + str(t)] for t in range(len(y)) ]
+                     for y in labels[part] ]),
+                 lengths=[ len(x) for x in insts[part] ])
+        paths.append(path)
+
+    streamed = list(npzMiniBatches(paths))
+    assert [ len(b[0]) for b in streamed ] == [ 5, len(insts) - 5 ]
+    for x, y in zip(insts, [ x for b in streamed for x in b[0] ]):
+        assert np.array_equal(x, y)
+
+    seen = [ i for batch, _ in miniBatches(list(range(len(insts))),
+                                           labels, 4)
+             for i in batch ]
+    assert sorted(seen) == list(range(len(insts)))
+
+@pytest.mark.parametrize('method', [ 'sgd', 'adagrad', 'adam' ])
+def test_stochastic_training_improves_held_out_likelihood(method):
+    crf, insts, labels, params = randomProblem(9, n=60)
+    weights, transProbs = crf._unpack(params)
+    truth  = CRF(weights, transProbs, None, None)
+    labels = truth.predict(insts)
+    train, heldOut = (insts[:40], labels[:40]), (insts[40:], labels[40:])
+
+    reported = []
+    crf.trainStochastic(lambda: miniBatches(train[0], train[1], 8),
+                        method=method, alpha=0.1, epochs=10,
+                        heldOut=heldOut, evalEvery=10,
+                        callback=lambda step, ll: reported.append((step, ll)))
+    history = crf.heldOutHistory()
+    assert [ step for step, ll in history ] == [ 10, 20, 30, 40, 50 ]
+    assert reported == history
+    assert history[-1][1] > history[0][1]
+
+def test_full_batch_training_records_held_out_likelihood():
+    crf, insts, labels, params = randomProblem(10, n=30)
+    heldOut = (insts[20:], labels[20:])
+    np.random.seed(0)
+    weights, transProbs = crf.train(insts[:20], labels[:20],
+                                    heldOut=heldOut, evalEvery=3)
+
+    steps = [ step for step, ll in crf.heldOutHistory() ]
+    assert steps[:-1] == list(range(3, 3 * len(steps), 3))
+    assert steps[-1] - steps[-2] <= 3
+    assert np.isclose(crf.heldOutHistory()[-1][1],
+                      crf.avgLogLikelihood(heldOut[0], heldOut[1], weights,
+                                           transProbs))
+
+def test_sparse_features_match_dense():
+    crf, insts, labels, params = randomProblem(2)
+    weights, transProbs = crf._unpack(params)
+    dense = crf.avgLogLikelihood(insts, labels, weights, transProbs)
+    csr   = crf.avgLogLikelihood([ sparse.csr_matrix(x) for x in insts ],
+                                 labels, weights, transProbs)
+    lists = crf.avgLogLikelihood([ [ np.nonzero(row)[0] for row in x ]
+                                   for x in insts ],
+                                 labels, weights, transProbs)
+    assert np.isclose(dense, csr) and np.isclose(dense, lists)
+
+def test_viterbi_matches_brute_force_with_padding():
+    rng         = np.random.default_rng(3)
+    unary       = rng.normal(size=(4, 5, L))
+    transitions = rng.normal(size=(L, L))
+    lengths     = [ 5, 3, 1, 4 ]
+    paths, scores = viterbi(unary, transitions, lengths)
+
+    for b, n in enumerate(lengths):
+        def score(y):
+            return (np.sum(unary[b, np.arange(n), list(y)]) +
+                    sum([ transitions[y[t], y[t+1]] for t in range(n - 1) ]))
+        best = max(itertools.product(range(L), repeat=n), key=score)
+        assert tuple(paths[b, :n]) == best
+        assert np.isclose(scores[b], score(best))
@@ -0,0 +1,130 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from BatchedFactor import BatchedFactor
+from Factor        import Factor
+from SparseFactor  import SparseFactor
+
+DOMAINS = { 'a' : 2, 'b' : 3, 'c' : 4, 'd' : 2 }
+
+def randomFactor(rng, variables, sparsity=0.0):
+    domains = [ DOMAINS[v] for v in variables ]
+    table   = rng.normal(size=domains)
+    table[rng.random(size=domains) < sparsity] = -np.inf
+    return Factor(variables, domains, table)
+
+# reference product: one entry at a time over the joint assignments
+def bruteProduct(factors, ordering):
+    domains = [ DOMAINS[v] for v in ordering ]
+    table   = np.zeros(domains)
+    for setting in itertools.product(*[ range(d) for d in domains ]):
+        assignment = dict(zip(ordering, setting))
+        table[setting] = sum([ f.get(dict([ (v, assignment[v])
+                                            for v in f.varOrdering() ]))
+                               for f in factors ])
+    return table
+
+# tensor of a (dense or sparse) factor with its axes in the given order
+def aligned(factor, ordering):
+    if hasattr(factor, 'toDense'):
+        factor = factor.toDense()
+    perm = [ list(factor.varOrdering()).index(v) for v in ordering ]
+    return np.transpose(factor._factor, perm)
+
+@pytest.mark.parametrize('scopes', [
+    [ ['a', 'b'], ['b', 'c'] ],
+    [ ['c', 'a'], ['a', 'b', 'd'], ['d'] ],
+    [ ['a', 'b'], ['b', 'a'] ],
+    [ ['b'], ['a', 'c'] ] ])
+def test_product_and_add_match_brute_force(scopes):
+    rng      = np.random.default_rng(1)
+    factors  = [ randomFactor(rng, s) for s in scopes ]
+    ordering = sorted(set([ v for s in scopes for v in s ]))
+    expected = bruteProduct(factors, ordering)
+
+    assert np.allclose(aligned(Factor.product(factors), ordering), expected)
+    added = factors[0]
+    for f in factors[1:]:
+        added = added.add(f)
+    assert np.allclose(aligned(added, ordering), expected)
+
+def test_eliminate_observe_and_logZ():
+    rng = np.random.default_rng(2)
+    f   = randomFactor(rng, ['a', 'b', 'c'])
+    t   = f._factor
+
+    assert np.allclose(f.eliminate(['b']).get({ 'a' : 1, 'c' : 2 }),
+                       np.log(np.sum(np.exp(t[1, :, 2]))))
+    assert np.allclose(f.observe('b', 2)._factor, t[:, 2, :])
+    assert np.isclose(f.logZ(), np.log(np.sum(np.exp(t))))
+    assert np.isclose(np.sum(f.toProbs()._factor), 1.0)
+
+def test_views_copy_on_write():
+    rng      = np.random.default_rng(3)
+    f        = randomFactor(rng, ['a', 'b'])
+    original = f._factor.copy()
+    g        = f.observe('a', 0)
+    g.set((1,), 100.0)
+    assert np.array_equal(f._factor, original)
+
+def test_batched_factor_matches_per_item_factors():
+    rng     = np.random.default_rng(4)
+    items   = [ randomFactor(rng, ['a', 'b']) for i in range(5) ]
+    other   = randomFactor(rng, ['b', 'c'])
+    batched = BatchedFactor.stack(items)
+
+    product = batched.add(other)
+    assert product.batchSize() == 5
+    for i, item in enumerate(items):
+        expected = item.add(other)
+        ordering = expected.varOrdering()
+        unstacked = product.unstack(i)
+        assert type(unstacked) is Factor
+        assert np.allclose(aligned(unstacked, ordering), expected._factor)
+        assert np.isclose(unstacked.logZ(), expected.logZ())
+        assert np.allclose(product.logZ()[i], expected.logZ())
+        assert np.allclose(aligned(unstacked.eliminate(['a']),
+                                   ['b', 'c']),
+                           aligned(expected.eliminate(['a']), ['b', 'c']))
+        assert np.allclose(batched.observe('b', 1).unstack(i)._factor,
+                           item.observe('b', 1)._factor)
+
+@pytest.mark.parametrize('scopes', [
+    [ ['a', 'b'], ['b', 'c'] ],
+    [ ['a', 'b', 'c'], ['c', 'a'] ],
+    [ ['a'], ['c', 'd'] ] ])
+def test_sparse_factor_matches_dense(scopes):
+    rng    = np.random.default_rng(5)
+    dense  = [ randomFactor(rng, s, sparsity=0.8) for s in scopes ]
+    sparse = [ SparseFactor.fromDense(f) for f in dense ]
+
+    expected = dense[0].add(dense[1])
+    ordering = expected.varOrdering()
+    for result in [ sparse[0].add(sparse[1]), sparse[0].add(dense[1]),
+                    dense[0].add(sparse[1]) ]:
+        assert np.allclose(aligned(result, ordering), expected._factor)
+    result = sparse[0].add(sparse[1])
+
+    assert np.isclose(result.logZ(), expected.logZ())
+    v = ordering[0]
+    assert np.allclose(aligned(result.eliminate([v]), ordering[1:]),
+                       aligned(expected.eliminate([v]), ordering[1:]))
+    assert np.allclose(aligned(result.observe(v, 1), ordering[1:]),
+                       aligned(expected.observe(v, 1), ordering[1:]))
+    assert np.allclose(aligned(result.marginal([v]), [v]),
+                       expected.marginal([v])._factor)
+
+def test_product_folds_in_sparse_operands():
+    rng     = np.random.default_rng(6)
+    scopes  = [ ['a', 'b'], ['b', 'c'], ['c', 'd'], ['a'] ]
+    dense   = [ randomFactor(rng, s, sparsity=0.7) for s in scopes ]
+    mixed   = [ SparseFactor.fromDense(dense[0]), dense[1],
+                SparseFactor.fromDense(dense[2]), dense[3] ]
+    ordering = [ 'a', 'b', 'c', 'd' ]
+    expected = bruteProduct(dense, ordering)
+
+    assert np.allclose(aligned(Factor.product(mixed), ordering), expected)
+    assert np.allclose(aligned(Factor.product(mixed[::2]), ordering),
+                       bruteProduct(dense[::2], ordering))
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from Factor       import Factor
+from SparseFactor import SparseFactor
+from JunctionTree import JunctionTree, eliminationOrder
+
+DOMAINS = { 'a' : 2, 'b' : 3, 'c' : 2, 'd' : 3, 'e' : 2, 'x' : 2, 'y' : 3 }
+
+def randomFactors(seed, scopes):
+    rng = np.random.default_rng(seed)
+    return [ Factor(s, [ DOMAINS[v] for v in s ],
+                    rng.normal(size=[ DOMAINS[v] for v in s ]))
+             for s in scopes ]
+
+# a loopy graph: a-b-c-d-a with a chord b-d and a pendant e
+LOOPY = [ ['a', 'b'], ['b', 'c'], ['c', 'd'], ['d', 'a'], ['b', 'd'],
+          ['d', 'e'], ['e'] ]
+
+def dense(factor):
+    return factor.toDense() if hasattr(factor, 'toDense') else factor
+
+def checkExact(tree, factors):
+    full = Factor.product(factors)
+    assert np.isclose(tree.logZ(), full.logZ())
+    marginals = tree.allMarginals()
+    for v in full.varOrdering():
+        assert np.allclose(dense(marginals[v])._factor,
+                           dense(full.marginal([v]).toProbs())._factor)
+
+@pytest.mark.parametrize('heuristic', [ 'minfill', 'minweight' ])
+def test_calibrated_tree_is_exact(heuristic):
+    factors = randomFactors(0, LOOPY)
+    tree    = JunctionTree(factors, heuristic)
+    tree.calibrate()
+    checkExact(tree, factors)
+
+    covered = set([ v for c in tree.getCliques() for v in c ])
+    assert covered == set(DOMAINS) - set([ 'x', 'y' ])
+    for f in factors:
+        assert any([ set(f.varOrdering()) <= set(c)
+                     for c in tree.getCliques() ])
+
+def test_disconnected_forest():
+    factors = randomFactors(1, LOOPY + [ ['x', 'y'], ['y'] ])
+    tree    = JunctionTree(factors)
+    tree.calibrate()
+    checkExact(tree, factors)
+
+def test_max_clique_size_and_refusal():
+    factors = randomFactors(2, [ ['a', 'b'], ['b', 'c'], ['c', 'a'] ])
+    tree    = JunctionTree(factors)
+    assert tree.maxCliqueSize() == 2 * 3 * 2
+    with pytest.raises(AssertionError):
+        tree.calibrate(maxEntries=11)
+    tree.calibrate(maxEntries=12)
+    checkExact(tree, factors)
+
+def test_elimination_order_covers_requested_variables():
+    scopes  = [ ['a', 'b'], ['b', 'c'], ['c', 'd'] ]
+    order, cliques = eliminationOrder(scopes, DOMAINS, 'minfill',
+                                      [ 'b', 'c' ])
+    assert sorted(order) == [ 'b', 'c' ]
+    assert len(cliques) == 2
+
+def test_sparse_and_dense_factors():
+    rng     = np.random.default_rng(3)
+    factors = randomFactors(3, LOOPY)
+    for f in factors[::2]:
+        f._factor[rng.random(f._factor.shape) < 0.3] = -np.inf
+    mixed = [ SparseFactor.fromDense(f) if i % 2 == 0 else f
+              for i, f in enumerate(factors) ]
+    assert np.isfinite(Factor.product(factors).logZ())
+    tree  = JunctionTree(mixed)
+    tree.calibrate()
+    checkExact(tree, factors)
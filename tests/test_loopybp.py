@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from Factor  import Factor
+from LoopyBP import LoopyBP
+
+def randomFactors(seed, scopes, domains):
+    rng = np.random.default_rng(seed)
+    return [ Factor(s, [ domains[v] for v in s ],
+                    rng.normal(size=[ domains[v] for v in s ]))
+             for s in scopes ]
+
+# a tree with mixed domains, a higher-order factor and unary factors
+DOMAINS = { 'a' : 2, 'b' : 3, 'c' : 2, 'd' : 3, 'e' : 2, 'f' : 2 }
+TREE    = [ ['a', 'b'], ['b', 'c'], ['b', 'd'], ['d', 'e', 'f'], ['a'],
+            ['c'], ['e'] ]
+
+@pytest.mark.parametrize('options', [
+    { 'schedule' : 'synchronous' },
+    { 'schedule' : 'residual' },
+    { 'schedule' : 'synchronous', 'damping' : 0.3 },
+    { 'schedule' : 'residual', 'damping' : 0.3 } ])
+def test_bp_is_exact_on_a_tree(options):
+    factors = randomFactors(0, TREE, DOMAINS)
+    bp      = LoopyBP(factors, tol=1e-10, maxIters=500, **options)
+    assert bp.run()
+
+    full      = Factor.product(factors)
+    marginals = bp.allMarginals()
+    for v in DOMAINS:
+        assert np.allclose(marginals[v]._factor,
+                           full.marginal([v]).toProbs()._factor, atol=1e-8)
+
+    stats = bp.stats()
+    assert stats['iterations'] == bp.iterations == len(stats['residuals'])
+    assert len(stats['updates']) == bp.iterations
+    assert stats['residuals'][-1] < 1e-10
+    assert stats['timePerSweep'] >= 0.0
+
+def test_bp_stops_after_max_iters():
+    loop = [ ['a', 'b'], ['b', 'c'], ['c', 'a'] ]
+    bp   = LoopyBP(randomFactors(1, loop, DOMAINS), tol=0.0, maxIters=3)
+    assert not bp.run()
+    assert bp.stats()['iterations'] == 3
+
+def test_residual_schedule_recomputes_only_affected_factors():
+    names   = [ 'v' + str(i) for i in range(12) ]
+    domains = dict([ (v, 2) for v in names ])
+    chain   = [ names[i:i + 2] for i in range(11) ] + [ [ v ] for v in names ]
+    factors = randomFactors(2, chain, domains)
+
+    sync     = LoopyBP(factors, tol=1e-10, maxIters=500)
+    residual = LoopyBP(factors, schedule='residual', tol=1e-10,
+                       maxIters=500, residualFraction=0.1)
+    assert sync.run() and residual.run()
+    for v in names:
+        assert np.allclose(residual.marginal(v)._factor,
+                           sync.marginal(v)._factor, atol=1e-8)
+
+    assert set(sync.stats()['updates']) == set([ len(chain) ])
+    assert max(residual.stats()['updates'][1:]) < len(chain)
@@ -0,0 +1,169 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from rbm import BatchLoader, BinaryRBM
+
+# two noisy prototypes: the first half of the units on or the second half
+def prototypeData(seed, n=1000, nO=12):
+    rng    = np.random.default_rng(seed)
+    protos = np.array([ [1] * (nO // 2) + [0] * (nO // 2),
+                        [0] * (nO // 2) + [1] * (nO // 2) ], dtype=float)
+    data   = protos[rng.integers(2, size=n)]
+    return protos, np.abs(data - (rng.random(data.shape) < 0.05))
+
+def reconstructs(rbm, protos):
+    dtype  = rbm._pparams.dtype
+    hidden = rbm._pHiddenGivenObs(protos.astype(dtype)) > 0.5
+    recon  = rbm._pObsGivenHidden(hidden.astype(dtype))
+    return np.all(np.abs(recon - protos) < 0.3)
+
+@pytest.mark.parametrize('options', [
+    { },
+    { 'persistent' : False, 'k' : 1 },
+    { 'persistent' : False, 'k' : 3, 'momentum' : 0.5 },
+    { 'momentum' : 0.5 },
+    { 'dtype' : np.float32 } ])
+def test_learn_recovers_the_prototypes(options):
+    protos, data = prototypeData(0)
+    rbm = BinaryRBM(12, 4)
+    obs, hid = rbm.learn(data, 15, 20, 50, 0.1, 0.001, seed=0, **options)
+    dtype = options.get('dtype', np.float64)
+    for param in (rbm._oparams, rbm._hparams, rbm._pparams, obs, hid):
+        assert param.dtype == dtype
+    assert np.all((obs == 0) | (obs == 1)) and np.all((hid == 0) | (hid == 1))
+    assert reconstructs(rbm, protos)
+
+def test_cd_returns_only_the_last_batch_chains():
+    # 9 rows in 4 batches: 3, 2, 2 and 2 rows
+    rbm = BinaryRBM(4, 2)
+    obs, hid = rbm.learn(np.ones((9, 4)), 1, 4, 5, 0.1, 0.0,
+                         persistent=False, seed=0)
+    assert obs.shape == (2, 4) and hid.shape == (2, 2)
+    obs, hid = rbm.learn(np.ones((9, 4)), 1, 4, 5, 0.1, 0.0, seed=0)
+    assert obs.shape == (5, 4) and hid.shape == (5, 2)
+
+def test_learn_is_reproducible_with_a_seed():
+    protos, data = prototypeData(1, n=200)
+    first, second = BinaryRBM(12, 3), BinaryRBM(12, 3)
+    first.learn(data, 2, 4, 10, 0.1, 0.001, seed=5)
+    second.learn(data, 2, 4, 10, 0.1, 0.001, seed=5)
+    assert np.array_equal(first._pparams, second._pparams)
+
+def test_loader_epochs_cover_every_row_once(tmpdir):
+    data = np.random.default_rng(5).integers(2, size=(103, 13))
+    path = str(tmpdir.join('packed.npy'))
+    BatchLoader.savePacked(path, data)
+    for loader in [ BatchLoader(data, 10, seed=0),
+                    BatchLoader(path, 10, nFeatures=13, prefetch=False) ]:
+        rows = np.concatenate(list(loader))
+        assert sorted(map(tuple, rows)) == sorted(map(tuple, data))
+
+def smallRBM(seed, nO=8, nH=3):
+    rng = np.random.default_rng(seed)
+    return BinaryRBM(nO, nH, rng.normal(0, 1, nO), rng.normal(0, 1, nH),
+                     rng.normal(0, 1.5, (nO, nH)))
+
+def settings(n):
+    return np.array(list(itertools.product([0, 1], repeat=n)), dtype=float)
+
+def exactObservedMeans(rbm):
+    joint = settings(rbm._nobserved + rbm._nhidden)
+    probs = np.exp(-rbm.energy(joint[:, :rbm._nobserved],
+                               joint[:, rbm._nobserved:]))
+    return np.dot(probs / np.sum(probs), joint[:, :rbm._nobserved])
+
+def test_block_gibbs_matches_exact_marginals():
+    rbm = smallRBM(3, nO=5, nH=2)
+    obs, hid = rbm.blockGibbs(4000, nChains=8, burnIn=20, seed=0)
+    assert obs.shape == (4000, 8, 5) and hid.shape == (4000, 8, 2)
+    assert np.allclose(np.mean(obs, (0, 1)), exactObservedMeans(rbm),
+                       atol=0.03)
+
+def test_block_gibbs_options_and_stream():
+    rbm = smallRBM(4, nO=5, nH=2)
+    obs, hid, energies = rbm.blockGibbs(30, nChains=3, burnIn=7, thin=3,
+                                        energies=True, seed=1)
+    assert energies.shape == (30, 3)
+    assert np.allclose(energies, rbm.energy(obs, hid))
+
+    # burn-in and thinning just skip sweeps of the same chains
+    every, _ = rbm.blockGibbs(7 + 90, nChains=3, seed=1)
+    assert np.array_equal(obs, every[7 + 2::3])
+
+    out = (np.zeros((30, 3, 5)), np.zeros((30, 3, 2)))
+    result = rbm.blockGibbs(30, nChains=3, burnIn=7, thin=3, out=out, seed=1)
+    assert result[0] is out[0] and result[1] is out[1]
+    assert np.array_equal(out[0], obs) and np.array_equal(out[1], hid)
+
+    batches = list(rbm.sampleStream(30, 8, nChains=3, burnIn=7, thin=3,
+                                    energies=True, seed=1))
+    assert [ len(b[0]) for b in batches ] == [ 8, 8, 8, 6 ]
+    assert np.array_equal(np.concatenate([ b[0] for b in batches ]), obs)
+    assert np.array_equal(np.concatenate([ b[1] for b in batches ]), hid)
+    assert np.allclose(np.concatenate([ b[2] for b in batches ]), energies)
+
+def test_parallel_tempering_matches_exact_marginals():
+    rbm = smallRBM(3, nO=5, nH=2)
+    obs, hid = rbm.parallelTempering(4000, nTemps=4, nChains=8, burnIn=20,
+                                     seed=0)
+    assert np.allclose(np.mean(obs, (0, 1)), exactObservedMeans(rbm),
+                       atol=0.03)
+    assert rbm.swapAcceptance.shape == (3,)
+    assert np.all(rbm.swapAcceptance > 0)
+
+def exactLogZ(rbm):
+    joint  = settings(rbm._nobserved + rbm._nhidden)
+    energy = rbm.energy(joint[:, :rbm._nobserved], joint[:, rbm._nobserved:])
+    return np.log(np.sum(np.exp(-energy)))
+
+def test_free_energy_sums_out_the_hidden_units():
+    rbm = smallRBM(0)
+    assert np.isclose(np.log(np.sum(np.exp(-rbm.freeEnergy(
+        settings(rbm._nobserved))))), exactLogZ(rbm))
+
+def test_ais_matches_exact_log_partition():
+    rbm = smallRBM(1)
+    logZ, stderr = rbm.logPartition(nRuns=200, nBetas=2000, seed=0)
+    assert abs(logZ - exactLogZ(rbm)) < max(5 * stderr, 0.05)
+
+def test_pseudo_likelihood_matches_exact_on_average():
+    rbm  = smallRBM(2)
+    data = settings(rbm._nobserved)[
+        np.random.default_rng(0).integers(2 ** rbm._nobserved, size=200)]
+
+    exact = 0.0
+    for i in range(rbm._nobserved):
+        flipped       = data.copy()
+        flipped[:, i] = 1 - flipped[:, i]
+        gap    = rbm.freeEnergy(flipped) - rbm.freeEnergy(data)
+        exact += np.mean(-np.logaddexp(0, -gap))
+    estimate = np.mean([ rbm.pseudoLogLikelihood(data, seed=s)
+                         for s in range(300) ])
+    assert abs(estimate - exact) < 0.05 * abs(exact)
+
+def test_learn_uses_exactly_B_batches(capsys):
+    rbm = BinaryRBM(2, 2)
+    rbm.learn(np.zeros((9, 2)), 1, 4, 3, 0.1, 0.0, verbose=True)
+    assert capsys.readouterr().out.count("Batch number") == 4
+    assert [ len(batch) for batch in BatchLoader(np.zeros((9, 2)),
+                                                 nBatches=4) ] == [3, 2, 2, 2]
+
+def test_loader_errors_reach_the_consumer():
+    class Broken(object):
+        shape = (10, 3)
+        ndim  = 2
+        def __getitem__(self, rows):
+            raise IOError("read failed")
+
+    loader = BatchLoader(Broken(), 5)
+    with pytest.raises(IOError):
+        list(loader)
+
+def test_tempered_learning_proposes_every_swap():
+    data = np.random.default_rng(4).integers(2, size=(200, 6)).astype(float)
+    rbm  = BinaryRBM(6, 3)
+    rbm.learn(data, 2, 10, 20, 0.05, 0.0, k=1, tempering=True, nTemps=5,
+              seed=0)
+    assert np.all(rbm.swapAcceptance > 0)